@@ -1,184 +1,113 @@
-import os, io, json, traceback, datetime, uuid, time, base64
+import os, io, sys, datetime, uuid, time, base64, contextlib
+_run_started = time.perf_counter()
 import streamlit as st
-import requests
 from dotenv import load_dotenv
 
-from utils import setup_logger
-from ocr import run_ocr, SUPPORTED_DOC_EXT
-from llm_agent import LLMClient
+from utils import setup_logger, log_stage, record_startup_profile
+from ocr import run_ocr_result, SUPPORTED_DOC_EXT
+from ingest import ingest_upload
+from llm_agent import get_llm_client
+from storage import create_invoice, update_invoice, upload_invoice_file, list_invoices, get_invoice, save_establishment, save_parsed_invoice, spend_by_establishment, top_products
+from storage import claim_invoice, update_claimed_invoice, release_invoice, RpcNotFound
+from worker import LeaseHeartbeat, LeaseLost
+from extraction import build_extraction_prompt, extract_json_from_llm_response, parse_invoice, parse_establishment, IncrementalJsonSections
 
 load_dotenv()
 logger = setup_logger()
 
-# Supabase configuration
-SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip("/")
-SUPABASE_API_KEY = os.getenv("SUPABASE_API_KEY", "")
-SUPABASE_TABLE = os.getenv("SUPABASE_TABLE", "invoices")
+# Startup profiling: PROFILE_STARTUP=1 or `streamlit run app.py -- --profile-startup`
+PROFILE_STARTUP = os.getenv("PROFILE_STARTUP", "") == "1" or "--profile-startup" in sys.argv
 
-REST_URL = f"{SUPABASE_URL}/rest/v1/{SUPABASE_TABLE}"
+# "inline" processes uploads in this Streamlit session; "worker" leaves them to worker.py
+PROCESSING_MODE = os.getenv("PROCESSING_MODE", "inline").lower()
+LEASE_SECONDS = int(os.getenv("WORKER_LEASE_SECONDS", "300"))
 
-HEADERS = {
-    "apikey": SUPABASE_API_KEY,
-    "Authorization": f"Bearer {SUPABASE_API_KEY}",
-    "Content-Type": "application/json",
-    "Prefer": "return=representation"
-}
+# Invoice list: light columns only, shared by all sessions for a few seconds and
+# cleared on every write made through save_invoice (workers' writes show up after the TTL)
+INVOICE_LIST_COLUMNS = "id,filename,status,created_at,error,ocr_confidence"
+INVOICE_LIST_LIMIT = int(os.getenv("INVOICE_LIST_LIMIT", "1000"))
 
-def _ensure_config():
-    """Ensure required configuration is present"""
-    if not SUPABASE_URL or not SUPABASE_API_KEY:
-        raise RuntimeError("Configure SUPABASE_URL e SUPABASE_API_KEY no .env")
-
-def create_invoice(filename: str):
-    """Create a new invoice record using Supabase REST API"""
-    _ensure_config()
-    payload = {
-        "filename": filename,
-        "status": "uploaded"
-    }
-    try:
-        response = requests.post(REST_URL, headers=HEADERS, data=json.dumps(payload), timeout=30)
-        if not response.ok:
-            raise RuntimeError(f"Erro ao criar invoice: {response.status_code} {response.text}")
-        result = response.json()
-        if result and len(result) > 0:
-            return result[0]
-        else:
-            raise RuntimeError("No data returned from insert operation")
-    except requests.exceptions.RequestException as e:
-        raise RuntimeError(f"Erro de conexão ao criar invoice: {str(e)}")
-    except Exception as e:
-        raise RuntimeError(f"Erro ao criar invoice: {str(e)}")
+@st.cache_data(ttl=int(os.getenv("INVOICE_LIST_TTL", "15")), show_spinner=False)
+def load_invoice_summaries() -> list:
+    """Most recent invoice of each filename, newest first"""
+    unique_invoices = {}
+    for inv in list_invoices(limit=INVOICE_LIST_LIMIT, columns=INVOICE_LIST_COLUMNS):
+        filename = inv.get('filename')
+        # Manter apenas o mais recente de cada arquivo
+        if filename not in unique_invoices or inv.get('created_at', '') > unique_invoices[filename].get('created_at', ''):
+            unique_invoices[filename] = inv
+    return sorted(unique_invoices.values(), key=lambda x: x.get('created_at', ''), reverse=True)
 
-def update_invoice(invoice_id: str, **fields):
-    """Update an existing invoice record using Supabase REST API"""
-    _ensure_config()
-    fields["updated_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-    url = f"{REST_URL}?id=eq.{invoice_id}"
-    try:
-        response = requests.patch(url, headers=HEADERS, data=json.dumps(fields), timeout=30)
-        if not response.ok:
-            raise RuntimeError(f"Erro ao atualizar invoice: {response.status_code} {response.text}")
-        result = response.json()
-        if result and len(result) > 0:
-            return result[0]
-        else:
-            return None
-    except requests.exceptions.RequestException as e:
-        raise RuntimeError(f"Erro de conexão ao atualizar invoice: {str(e)}")
-    except Exception as e:
-        raise RuntimeError(f"Erro ao atualizar invoice: {str(e)}")
+def save_invoice(invoice_id: str, lease: str = None, **fields):
+    """
+    update_invoice + invalidate the cached invoice list. With lease (see
+    claim_for_session) the write only applies while this session still holds it.
+    """
+    if lease:
+        row = update_claimed_invoice(invoice_id, lease, **fields)
+        if row is None:
+            raise LeaseLost(invoice_id)
+    else:
+        row = update_invoice(invoice_id, **fields)
+    load_invoice_summaries.clear()
+    if row and "invoice_updates" in st.session_state:
+        # Lets the row fragment show the new status without a full rerun
+        st.session_state.invoice_updates[invoice_id] = {k: row.get(k) for k in INVOICE_LIST_COLUMNS.split(",")}
+    return row
 
-def list_invoices(limit: int = 100):
-    """List invoices ordered by creation date using Supabase REST API"""
-    _ensure_config()
-    url = f"{REST_URL}?select=*&order=created_at.desc&limit={limit}"
-    try:
-        response = requests.get(url, headers=HEADERS, timeout=30)
-        if not response.ok:
-            raise RuntimeError(f"Erro ao listar invoices: {response.status_code} {response.text}")
-        result = response.json()
-        return result if result else []
-    except requests.exceptions.RequestException as e:
-        raise RuntimeError(f"Erro de conexão ao listar invoices: {str(e)}")
-    except Exception as e:
-        raise RuntimeError(f"Erro ao listar invoices: {str(e)}")
+def save_error(invoice_id: str, error: Exception, lease: str = None):
+    """Record a failed stage, unless the lease was lost (the row is someone else's now)"""
+    if isinstance(error, LeaseLost):
+        logger.warning("Reserva perdida; invoice assumida por um worker", extra={"invoice_id": invoice_id})
+        return
+    save_invoice(invoice_id, lease=lease, status="error", error=str(error))
 
-def extract_json_from_llm_response(response_text):
-    """Extract JSON content from LLM response text, focusing on invoice data structure"""
-    if not response_text:
+def claim_for_session(invoice_id: str):
+    """
+    Claim the invoice's lease for this session, so no worker processes it at
+    the same time (and this session doesn't touch a row a worker is on).
+    Returns the lease owner for save_invoice(lease=...), or None when the lease
+    SQL is not installed, in which case no worker can be running either.
+    """
+    owner = st.session_state.setdefault("lease_owner", f"app-{uuid.uuid4().hex[:12]}")
+    try:
+        row = claim_invoice(invoice_id, owner, LEASE_SECONDS)
+    except RpcNotFound:
         return None
-    
-    # If response_text is already a dict, check if it contains invoice data structure
-    if isinstance(response_text, dict):
-        # If it's a complex response with 'raw' field, extract the content
-        if 'raw' in response_text and isinstance(response_text['raw'], dict):
-            raw_content = response_text['raw']
-            if 'choices' in raw_content and len(raw_content['choices']) > 0:
-                message_content = raw_content['choices'][0].get('message', {}).get('content', '')
-                return extract_invoice_json_from_content(message_content)
-        
-        # If it's a complex response with 'content' field, extract from content
-        if 'content' in response_text:
-            return extract_invoice_json_from_content(response_text['content'])
-        
-        # If it already looks like invoice data (has emitente, CNPJ_CPF, etc.), return it
-        if any(key in response_text for key in ['emitente', 'CNPJ_CPF', 'itens', 'valores']):
-            return response_text
-        
-        return response_text
-    
-    # If response_text is not a string, convert it
-    if not isinstance(response_text, str):
-        response_text = str(response_text)
-    
-    return extract_invoice_json_from_content(response_text)
+    if row is None:
+        raise RuntimeError("Invoice em processamento por um worker; tente novamente em instantes")
+    return owner
 
-def extract_invoice_json_from_content(content):
-    """Extract invoice JSON from text content"""
-    import re
-    
-    # Clean the text - remove common LLM prefixes/suffixes
-    cleaned_text = content.strip()
-    
-    # Remove common prefixes that LLMs might add
-    prefixes_to_remove = [
-        "Aqui está a extração e normalização dos dados da nota fiscal em formato JSON:",
-        "Aqui está o JSON:",
-        "Segue o JSON:",
-        "JSON:",
-        "```json",
-        "```",
-        "Resposta:",
-        "Resultado:"
-    ]
-    
-    for prefix in prefixes_to_remove:
-        if cleaned_text.lower().startswith(prefix.lower()):
-            cleaned_text = cleaned_text[len(prefix):].strip()
-    
-    # Remove trailing ``` if present
-    if cleaned_text.endswith("```"):
-        cleaned_text = cleaned_text[:-3].strip()
-    
-    # Remove any text after the JSON (like "Observações:")
-    json_end_pattern = r'\n\nObservações?:'
-    cleaned_text = re.split(json_end_pattern, cleaned_text)[0]
-    
-    # Try to parse the cleaned text as JSON
+@contextlib.contextmanager
+def session_lease(invoice_id: str, lease: str):
+    """Keep a lease from claim_for_session alive while the block runs, then give it back"""
+    if lease is None:
+        yield
+        return
+    heartbeat = LeaseHeartbeat(lease, LEASE_SECONDS, logger)
+    heartbeat.start()
     try:
-        parsed_json = json.loads(cleaned_text)
-        # Verify it looks like invoice data
-        if isinstance(parsed_json, dict) and any(key in parsed_json for key in ['emitente', 'CNPJ_CPF', 'itens', 'valores']):
-            return parsed_json
-    except json.JSONDecodeError:
-        pass
-    
-    # Look for JSON objects in the text (more robust pattern)
-    json_pattern = r'\{(?:[^{}]|{[^{}]*})*\}'
-    matches = re.findall(json_pattern, cleaned_text, re.DOTALL)
-    
-    if matches:
-        # Try to parse the largest match (most likely to be the complete JSON)
-        largest_match = max(matches, key=len)
+        yield
+    finally:
+        heartbeat.stop()
         try:
-            parsed_json = json.loads(largest_match)
-            # Verify it looks like invoice data
-            if isinstance(parsed_json, dict) and any(key in parsed_json for key in ['emitente', 'CNPJ_CPF', 'itens', 'valores']):
-                return parsed_json
-        except json.JSONDecodeError:
-            # Try all matches
-            for match in matches:
-                try:
-                    parsed_json = json.loads(match)
-                    # Verify it looks like invoice data
-                    if isinstance(parsed_json, dict) and any(key in parsed_json for key in ['emitente', 'CNPJ_CPF', 'itens', 'valores']):
-                        return parsed_json
-                except json.JSONDecodeError:
-                    continue
-    
-    # If no valid invoice JSON found, return a structured error response
-    return {"error": "Resposta não contém JSON válido de nota fiscal", "raw_response": content[:200] + "..." if len(content) > 200 else content}
+            release_invoice(invoice_id, lease)
+        except Exception:
+            logger.exception("Falha ao liberar reserva", extra={"invoice_id": invoice_id})
+
+def save_llm_result(invoice_id: str, resp: dict, lease: str = None):
+    """Persist the LLM response and write its normalized extraction for analytics"""
+    save_invoice(invoice_id, lease=lease, status="llm_sent", llm_response=resp, error=None)
+    parsed = parse_invoice(resp)
+    if parsed is None:
+        logger.warning("Resposta LLM sem JSON de nota fiscal válido; tabelas normalizadas não atualizadas",
+                       extra={"invoice_id": invoice_id})
+        return
+    try:
+        save_parsed_invoice(invoice_id, parsed)
+    except Exception:
+        # The raw response is already saved; analytics tables can be rebuilt later
+        logger.exception("Falha ao salvar dados normalizados", extra={"invoice_id": invoice_id})
 
 st.set_page_config(page_title="Invoice OCR + LLM", layout="wide")
 
@@ -207,11 +136,58 @@ div[data-testid="stDialog"] > div {
 </style>
 """, unsafe_allow_html=True)
 
+def stream_llm_to_status(invoice_id: str, prompt: str) -> dict:
+    """
+    Stream the LLM answer inside the current st.status block, showing each JSON
+    section as soon as it is complete. The establishment is saved right away,
+    before the rest of the answer arrives.
+    """
+    # Clicking it reruns the script, which closes the stream at the next UI update;
+    # the invoice stays in ocr_done and can be sent again from the table
+    st.button("⏹️ Interromper", key=f"stop_llm_{invoice_id}")
+    progress = st.empty()
+    sections = IncrementalJsonSections()
+    last_update = 0.0
+
+    def on_delta(delta: str, content: str):
+        nonlocal last_update, sections
+        if delta == content and sections.buffer:
+            # LLMRouter switched to another provider's answer (see LLMRouter.send): parse it from the start
+            st.write("🔁 Usando a resposta de outro provedor")
+            sections = IncrementalJsonSections()
+        for key, value in sections.feed(delta).items():
+            if key == "estabelecimento":
+                establishment = parse_establishment(value)
+                if establishment:
+                    st.write(f"🏪 {establishment['nome'] or 'Estabelecimento'} — CNPJ {establishment['cnpj']}")
+                    try:
+                        save_establishment(establishment)
+                    except Exception:
+                        logger.exception("Falha ao salvar estabelecimento antecipadamente")
+            elif key == "nota_fiscal" and isinstance(value, dict):
+                st.write(f"🧾 Nota {value.get('numero') or '?'} / série {value.get('serie') or '?'} — emissão {value.get('data_emissao') or '?'}")
+            elif key == "itens" and isinstance(value, list):
+                st.write(f"🛒 {len(value)} itens")
+            elif key == "totais" and isinstance(value, dict):
+                st.write(f"💰 Total: {value.get('valor_total')}")
+        # Every Streamlit call is a message to the browser, so redraw the counter at most 4x/s
+        now = time.perf_counter()
+        if now - last_update >= 0.25:
+            progress.caption(f"Recebendo resposta... {len(content)} caracteres")
+            last_update = now
+
+    resp = get_llm_client().send(prompt, on_delta=on_delta)
+    progress.empty()
+    return resp
+
 st.title("Invoice OCR + LLM")
 
 
 st.subheader("Upload de notas fiscais")
-st.info("ℹ️ **Processamento Automático**: Após o upload, o OCR e análise por LLM serão executados automaticamente. Acompanhe o progresso abaixo.")
+if PROCESSING_MODE == "worker":
+    st.info("ℹ️ **Processamento em segundo plano**: Após o upload, o OCR e a análise por LLM são executados pelos workers (`worker.py`). Atualize a lista abaixo para acompanhar o status.")
+else:
+    st.info("ℹ️ **Processamento Automático**: Após o upload, o OCR e análise por LLM serão executados automaticamente. Acompanhe o progresso abaixo.")
 uploaded_files = st.file_uploader("Selecione imagens ou PDFs", type=[e.strip(".") for e in SUPPORTED_DOC_EXT], accept_multiple_files=True)
 
 # Initialize session state for tracking uploaded files
@@ -227,15 +203,15 @@ if uploaded_files:
         try:
             # Check if this file was already uploaded (avoid duplicates)
             if f.name not in st.session_state.uploaded_filenames:
-                # Read file bytes first
-                file_bytes = f.read()
-                
-                # Convert to base64 for storage in database
-                file_base64 = base64.b64encode(file_bytes).decode('utf-8')
+                # Hash the upload and keep its bytes as a single buffer shared by the upload and OCR
+                ingested = ingest_upload(f)
+                file_bytes = ingested.buffer
                 
                 # Create invoice record
                 inv = create_invoice(f.name)
                 invoice_id = inv["id"]
+                # Inline processing: claim the row before image_data exists, so no worker can take it
+                lease = claim_for_session(invoice_id) if PROCESSING_MODE != "worker" else None
                 
                 # Get file extension and MIME type
                 file_extension = os.path.splitext(f.name)[1].lower()
@@ -251,112 +227,39 @@ if uploaded_files:
                 }
                 mime_type = mime_types.get(file_extension, 'application/octet-stream')
                 
-                # Update invoice with base64 image data
-                update_invoice(invoice_id, 
-                              image_data=file_base64,
-                              image_mime_type=mime_type,
-                              image_filename=f.name)
+                # Store the file as base64, encoded while the request streams
+                upload_invoice_file(invoice_id, file_bytes, mime_type=mime_type,
+                                    filename=f.name, sha256=ingested.sha256)
+                load_invoice_summaries.clear()
                 
                 # Store mapping and cache
                 st.session_state.uploaded_filenames[f.name] = invoice_id
                 st.session_state.files_cache[invoice_id] = file_bytes
                 
                 st.success(f"✅ Arquivo registrado: {f.name}")
-                logger.info(f"Arquivo {f.name} registrado com ID {invoice_id}, armazenado em base64 ({len(file_base64)} chars)")
+                logger.info(f"Arquivo {f.name} registrado ({ingested.size} bytes, sha256 {ingested.sha256[:12]})",
+                            extra={"invoice_id": invoice_id, "file_name": f.name})
                 
                 # AUTOMATIC PROCESSING: OCR + LLM
-                if invoice_id not in st.session_state.processed_files:
+                if PROCESSING_MODE != "worker" and invoice_id not in st.session_state.processed_files:
                     st.info(f"🔄 Processamento automático iniciado para: {f.name}")
                     
                     # Step 1: Run OCR
-                    with st.status(f"📄 Processando {f.name}...", expanded=True) as status:
+                    with st.status(f"📄 Processando {f.name}...", expanded=True) as status, session_lease(invoice_id, lease):
                         st.write("⏳ Executando OCR...")
                         try:
-                            text = run_ocr(file_bytes, f.name)
-                            update_invoice(invoice_id, status="ocr_done", ocr_text=text, error=None)
+                            with log_stage(logger, "ocr", invoice_id=invoice_id, file_name=f.name):
+                                ocr_result = run_ocr_result(file_bytes, f.name)
+                                text = ocr_result.text
+                                save_invoice(invoice_id, lease=lease, status="ocr_done", ocr_text=text, ocr_confidence=ocr_result.summary(), error=None)
                             st.write("✅ OCR concluído!")
-                            logger.info(f"OCR automático concluído para {f.name}")
                             
                             # Step 2: Send to LLM
                             st.write("⏳ Enviando para LLM...")
-                            client = LLMClient()
-                            prompt = (
-                                "Segue o texto OCR de uma nota fiscal emitida no Brasil de acordo com as regras vigentes. Extraia os principais campos (emitente, CNPJ/CPF, "
-                                "data, itens, valores, impostos) e retorne em JSON bem estruturado de acordo com o schema abaixo, com campos ausentes como null. "
-                                "Para campos de endereço, caso a informação não esteja presente no texto OCR ou seja incompleta ou seja inválida, retorne null. "
-                                "O seu retorno deve ser apenas o JSON, sem nenhum outro texto adicional. É extremamente importante que você retorne APENAS o JSON, sem nenhum outro texto adicional."
-                                "Use exatamente o formato definido no schema abaixo:\n\n"
-                                "JSON Schema:\n"
-                                "{\n"
-                                '  "$schema": "https://json-schema.org/draft/2020-12/schema",\n'
-                                '  "title": "NotaFiscalSchema",\n'
-                                '  "type": "object",\n'
-                                '  "properties": {\n'
-                                '    "estabelecimento": {\n'
-                                '      "type": "object",\n'
-                                '      "properties": {\n'
-                                '        "nome": { "type": "string" },\n'
-                                '        "cnpj": { "type": "string" },\n'
-                                '        "telefone": { "type": "string" },\n'
-                                '        "inscricao_estadual": { "type": "string" },\n'
-                                '        "endereco": {\n'
-                                '          "type": "object",\n'
-                                '          "properties": {\n'
-                                '            "logradouro": { "type": "string" },\n'
-                                '            "bairro": { "type": "string" },\n'
-                                '            "cidade": { "type": "string" },\n'
-                                '            "estado": { "type": "string" }\n'
-                                '          },\n'
-                                '          "required": ["logradouro", "bairro", "cidade", "estado"]\n'
-                                '        }\n'
-                                '      },\n'
-                                '      "required": ["nome", "cnpj", "telefone", "inscricao_estadual", "endereco"]\n'
-                                '    },\n'
-                                '    "nota_fiscal": {\n'
-                                '      "type": "object",\n'
-                                '      "properties": {\n'
-                                '        "tipo": { "type": "string" },\n'
-                                '        "numero": { "type": "string" },\n'
-                                '        "serie": { "type": "string" },\n'
-                                '        "data_emissao": { "type": "string", "format": "date-time" },\n'
-                                '        "chave_acesso": { "type": "string" },\n'
-                                '        "protocolo_autorizacao": { "type": "string" },\n'
-                                '        "consumidor": { "type": "string" }\n'
-                                '      },\n'
-                                '      "required": ["tipo", "numero", "serie", "data_emissao", "chave_acesso", "protocolo_autorizacao", "consumidor"]\n'
-                                '    },\n'
-                                '    "itens": {\n'
-                                '      "type": "array",\n'
-                                '      "items": {\n'
-                                '        "type": "object",\n'
-                                '        "properties": {\n'
-                                '          "codigo": { "type": ["string", "null"] },\n'
-                                '          "descricao": { "type": "string" },\n'
-                                '          "quantidade": { "type": "number" },\n'
-                                '          "valor_unitario": { "type": "number" },\n'
-                                '          "valor_total": { "type": "number" }\n'
-                                '        },\n'
-                                '        "required": ["descricao", "quantidade", "valor_unitario", "valor_total"]\n'
-                                '      }\n'
-                                '    },\n'
-                                '    "totais": {\n'
-                                '      "type": "object",\n'
-                                '      "properties": {\n'
-                                '        "valor_total": { "type": "number" },\n'
-                                '        "forma_pagamento": { "type": "string" },\n'
-                                '        "valor_pago": { "type": "number" }\n'
-                                '      },\n'
-                                '      "required": ["valor_total", "forma_pagamento", "valor_pago"]\n'
-                                '    }\n'
-                                '  },\n'
-                                '  "required": ["estabelecimento", "nota_fiscal", "itens", "totais"]\n'
-                                "}\n\n"
-                                f"Texto OCR:\n{text}"
-                            )
-                            resp = client.send(prompt)
-                            update_invoice(invoice_id, status="llm_sent", llm_response=resp, error=None)
+                            with log_stage(logger, "llm", invoice_id=invoice_id, file_name=f.name):
+                                resp = stream_llm_to_status(invoice_id, build_extraction_prompt(text))
+                                save_llm_result(invoice_id, resp, lease=lease)
                             st.write("✅ Processamento LLM concluído!")
-                            logger.info(f"LLM automático concluído para {f.name}")
                             
                             # Mark as processed
                             st.session_state.processed_files.add(invoice_id)
@@ -364,9 +267,7 @@ if uploaded_files:
                             status.update(label=f"✅ {f.name} - Processamento completo!", state="complete")
                             
                         except Exception as e:
-                            tb = traceback.format_exc()
-                            logger.error(tb)
-                            update_invoice(invoice_id, status="error", error=str(e))
+                            save_error(invoice_id, e, lease=lease)
                             status.update(label=f"❌ {f.name} - Erro no processamento", state="error")
                             st.error(f"Erro ao processar: {e}")
                 
@@ -375,9 +276,8 @@ if uploaded_files:
                 invoice_id = st.session_state.uploaded_filenames[f.name]
                 if invoice_id not in st.session_state.files_cache:
                     # Re-read and cache if not in cache
-                    file_bytes = f.read()
-                    st.session_state.files_cache[invoice_id] = file_bytes
-                    logger.info(f"Arquivo {f.name} re-cacheado com ID {invoice_id}")
+                    st.session_state.files_cache[invoice_id] = ingest_upload(f).buffer
+                    logger.info(f"Arquivo {f.name} re-cacheado", extra={"invoice_id": invoice_id, "file_name": f.name})
         except Exception as e:
             err = f"Falha ao registrar {f.name}: {e}"
             logger.exception(err)
@@ -388,98 +288,24 @@ st.subheader("Processamento")
 
 def do_ocr(invoice_id: str, file_bytes: bytes, filename: str):
     try:
-        text = run_ocr(file_bytes, filename)
-        update_invoice(invoice_id, status="ocr_done", ocr_text=text, error=None)
+        with log_stage(logger, "ocr", invoice_id=invoice_id, file_name=filename):
+            ocr_result = run_ocr_result(file_bytes, filename)
+            save_invoice(invoice_id, status="ocr_done", ocr_text=ocr_result.text, ocr_confidence=ocr_result.summary(), error=None)
         st.success(f"OCR ok: {filename}")
     except Exception as e:
-        tb = traceback.format_exc()
-        logger.error(tb)
-        update_invoice(invoice_id, status="error", error=str(e))
+        save_invoice(invoice_id, status="error", error=str(e))
         st.error(f"OCR falhou: {e}")
 
 def do_llm(invoice_id: str, text: str):
     try:
-        client = LLMClient()
-        prompt = (
-            "Segue o texto OCR de uma nota fiscal emitida no Brasil de acordo com as regras vigentes. Extraia os principais campos (emitente, CNPJ/CPF, "
-            "data, itens, valores, impostos) e retorne em JSON bem estruturado de acordo com o schema abaixo, com campos ausentes como null. "
-            "Para campos de endereço, caso a informação não esteja presente no texto OCR ou seja incompleta ou seja inválida, retorne null. "
-            "O seu retorno deve ser apenas o JSON, sem nenhum outro texto adicional. É extremamente importante que você retorne APENAS o JSON, sem nenhum outro texto adicional."
-            "Use exatamente o formato definido no schema abaixo:\n\n"
-            "JSON Schema:\n"
-            "{\n"
-            '  "$schema": "https://json-schema.org/draft/2020-12/schema",\n'
-            '  "title": "NotaFiscalSchema",\n'
-            '  "type": "object",\n'
-            '  "properties": {\n'
-            '    "estabelecimento": {\n'
-            '      "type": "object",\n'
-            '      "properties": {\n'
-            '        "nome": { "type": "string" },\n'
-            '        "cnpj": { "type": "string" },\n'
-            '        "telefone": { "type": "string" },\n'
-            '        "inscricao_estadual": { "type": "string" },\n'
-            '        "endereco": {\n'
-            '          "type": "object",\n'
-            '          "properties": {\n'
-            '            "logradouro": { "type": "string" },\n'
-            '            "bairro": { "type": "string" },\n'
-            '            "cidade": { "type": "string" },\n'
-            '            "estado": { "type": "string" }\n'
-            '          },\n'
-            '          "required": ["logradouro", "bairro", "cidade", "estado"]\n'
-            '        }\n'
-            '      },\n'
-            '      "required": ["nome", "cnpj", "telefone", "inscricao_estadual", "endereco"]\n'
-            '    },\n'
-            '    "nota_fiscal": {\n'
-            '      "type": "object",\n'
-            '      "properties": {\n'
-            '        "tipo": { "type": "string" },\n'
-            '        "numero": { "type": "string" },\n'
-            '        "serie": { "type": "string" },\n'
-            '        "data_emissao": { "type": "string", "format": "date-time" },\n'
-            '        "chave_acesso": { "type": "string" },\n'
-            '        "protocolo_autorizacao": { "type": "string" },\n'
-            '        "consumidor": { "type": "string" }\n'
-            '      },\n'
-            '      "required": ["tipo", "numero", "serie", "data_emissao", "chave_acesso", "protocolo_autorizacao", "consumidor"]\n'
-            '    },\n'
-            '    "itens": {\n'
-            '      "type": "array",\n'
-            '      "items": {\n'
-            '        "type": "object",\n'
-            '        "properties": {\n'
-            '          "codigo": { "type": ["string", "null"] },\n'
-            '          "descricao": { "type": "string" },\n'
-            '          "quantidade": { "type": "number" },\n'
-            '          "valor_unitario": { "type": "number" },\n'
-            '          "valor_total": { "type": "number" }\n'
-            '        },\n'
-            '        "required": ["descricao", "quantidade", "valor_unitario", "valor_total"]\n'
-            '      }\n'
-            '    },\n'
-            '    "totais": {\n'
-            '      "type": "object",\n'
-            '      "properties": {\n'
-            '        "valor_total": { "type": "number" },\n'
-            '        "forma_pagamento": { "type": "string" },\n'
-            '        "valor_pago": { "type": "number" }\n'
-            '      },\n'
-            '      "required": ["valor_total", "forma_pagamento", "valor_pago"]\n'
-            '    }\n'
-            '  },\n'
-            '  "required": ["estabelecimento", "nota_fiscal", "itens", "totais"]\n'
-            "}\n\n"
-            f"Texto OCR:\n{text}"
-        )
-        resp = client.send(prompt)
-        update_invoice(invoice_id, status="llm_sent", llm_response=resp, error=None)
+        with log_stage(logger, "llm", invoice_id=invoice_id):
+            client = get_llm_client()
+            prompt = build_extraction_prompt(text)
+            resp = client.send(prompt)
+            save_llm_result(invoice_id, resp)
         st.success("Envio para LLM ok")
     except Exception as e:
-        tb = traceback.format_exc()
-        logger.error(tb)
-        update_invoice(invoice_id, status="error", error=str(e))
+        save_invoice(invoice_id, status="error", error=str(e))
         st.error(f"LLM falhou: {e}")
 
 # Funções para modalboxes usando st.dialog
@@ -530,7 +356,7 @@ def show_ocr_dialog(invoice_id: str, filename: str, current_text: str, image_dat
     with col_save:
         if st.button("💾 Salvar Alterações", type="primary"):
             try:
-                update_invoice(invoice_id, ocr_text=new_text)
+                save_invoice(invoice_id, ocr_text=new_text)
                 st.success("✅ Texto salvo com sucesso!")
                 st.rerun()
             except Exception as e:
@@ -564,40 +390,153 @@ def show_llm_dialog(filename: str, llm_response):
     if st.button("❌ Fechar", key=f"close_llm_{filename}"):
         st.stop()
 
+def render_status(status: str):
+    if status == 'error':
+        st.error(status)
+    elif status == 'llm_sent':
+        st.success(status)
+    elif status == 'ocr_done':
+        st.info(status)
+    else:
+        st.write(status)
+
+def format_created_at(created_at: str) -> str:
+    if not created_at:
+        return 'N/A'
+    # Formatar data para exibição mais amigável
+    try:
+        dt = datetime.datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+        return dt.strftime('%d/%m/%Y %H:%M')
+    except ValueError:
+        return created_at[:16]  # Mostrar apenas parte da data
+
+def _claim_or_warn(invoice_id: str):
+    """claim_for_session for the row buttons; False (after a warning) when the row can't be claimed"""
+    try:
+        return claim_for_session(invoice_id)
+    except RuntimeError as e:
+        st.warning(f"⚠️ {e}")
+        return False
+
+@st.fragment
+def invoice_row(inv: dict):
+    """One table row; its buttons rerun only this fragment, not the whole page"""
+    inv = st.session_state.invoice_updates.get(inv["id"], inv)
+    col1, col2, col3, col4 = st.columns([4, 2, 2, 2])
+
+    with col1:
+        filename = inv.get('filename', 'N/A')
+        # Check if file is in cache
+        is_cached = inv["id"] in st.session_state.get("files_cache", {})
+        cache_indicator = "📎" if is_cached else "📄"
+        st.write(f"{cache_indicator} {filename}")
+
+    with col2:
+        render_status(inv.get('status', 'N/A'))
+        confidence = inv.get('ocr_confidence')
+        if confidence:
+            st.caption(f"OCR {confidence.get('mean', 0):.0f}% · {confidence.get('reocr_improved', 0)} linha(s) relida(s)")
+
+    with col3:
+        st.write(format_created_at(inv.get('created_at', '')))
+
+    with col4:
+        # Usar expander para as ações
+        with st.expander("⚙️ Ações", expanded=False):
+            file_cache = st.session_state.get("files_cache", {}).get(inv["id"])
+
+            # Botão para visualizar/editar OCR (colunas pesadas só são buscadas ao abrir)
+            if st.button("📝 Visualizar/Editar OCR", key=f"view_ocr_{inv['id']}", use_container_width=True):
+                full = get_invoice(inv["id"], columns="ocr_text,image_data,image_mime_type") or {}
+                show_ocr_dialog(inv["id"], filename, full.get("ocr_text") or "", full.get("image_data"), full.get("image_mime_type"))
+
+            # Botão para visualizar resposta LLM
+            if inv.get("status") == "llm_sent":
+                if st.button("🤖 Ver Resposta LLM", key=f"view_llm_{inv['id']}", use_container_width=True):
+                    full = get_invoice(inv["id"], columns="llm_response") or {}
+                    show_llm_dialog(filename, full.get("llm_response"))
+
+            # Botão para executar OCR
+            if st.button("🔄 Executar OCR", key=f"run_ocr_{inv['id']}", use_container_width=True):
+                # Debug: log cache status
+                logger.debug(f"OCR solicitado; cache disponível: {file_cache is not None}, tamanho: {len(file_cache) if file_cache else 0} bytes",
+                             extra={"invoice_id": inv["id"], "file_name": filename})
+
+                if file_cache is None:
+                    st.error("⚠️ Arquivo não está em cache. Por favor, faça upload do arquivo novamente usando o campo acima.")
+                    st.info("💡 **Dica**: Mantenha o arquivo selecionado no campo de upload enquanto processa.")
+                elif (lease := _claim_or_warn(inv["id"])) is not False:
+                    with st.spinner("Processando OCR..."), session_lease(inv["id"], lease):
+                        try:
+                            with log_stage(logger, "ocr", invoice_id=inv["id"], file_name=filename):
+                                ocr_result = run_ocr_result(file_cache, filename)
+                                save_invoice(inv["id"], lease=lease, status="ocr_done", ocr_text=ocr_result.text, ocr_confidence=ocr_result.summary(), error=None)
+                        except Exception as e:
+                            save_error(inv["id"], e, lease=lease)
+                            st.error(f"❌ OCR falhou: {e}")
+                        else:
+                            st.toast(f"✅ OCR concluído: {filename}")
+                            st.rerun(scope="fragment")
+
+            # Botão para enviar para LLM
+            if st.button("🚀 Enviar para LLM", key=f"send_llm_{inv['id']}", use_container_width=True):
+                text_val = (get_invoice(inv["id"], columns="ocr_text") or {}).get("ocr_text") or ""
+                if not text_val:
+                    st.warning("⚠️ Texto OCR vazio. Execute o OCR primeiro.")
+                elif (lease := _claim_or_warn(inv["id"])) is not False:
+                    with st.spinner("Enviando para LLM..."), session_lease(inv["id"], lease):
+                        try:
+                            with log_stage(logger, "llm", invoice_id=inv["id"], file_name=filename):
+                                client = get_llm_client()
+                                prompt = build_extraction_prompt(text_val)
+                                resp = client.send(prompt)
+                                save_llm_result(inv["id"], resp, lease=lease)
+                        except Exception as e:
+                            save_error(inv["id"], e, lease=lease)
+                            st.error(f"❌ LLM falhou: {e}")
+                        else:
+                            st.toast("✅ Envio para LLM concluído!")
+                            st.rerun(scope="fragment")
+
+    # Exibir erro se houver
+    err = inv.get("error")
+    if err:
+        st.error(f"Erro registrado: {err}")
+
+    st.divider()
+
 try:
-    invoices = list_invoices(limit=200)
+    invoices = load_invoice_summaries()
 except Exception as e:
     st.error(f"Erro ao listar invoices: {e}")
     invoices = []
 
+# Row updates made by fragments since the last full run (the cache is fresh again now)
+st.session_state.invoice_updates = {}
+
 if not invoices:
     st.info("Nenhum registro ainda.")
 else:
-    # Agrupar invoices por filename e manter apenas o mais recente de cada arquivo
-    unique_invoices = {}
-    for inv in invoices:
-        filename = inv.get('filename')
-        if filename not in unique_invoices:
-            unique_invoices[filename] = inv
-        else:
-            # Comparar timestamps para manter o mais recente
-            current_created = inv.get('created_at', '')
-            existing_created = unique_invoices[filename].get('created_at', '')
-            if current_created > existing_created:
-                unique_invoices[filename] = inv
-    
-    # Ordenar os invoices únicos por data de criação (mais recente primeiro)
-    sorted_unique_invoices = sorted(unique_invoices.values(), 
-                                   key=lambda x: x.get('created_at', ''), 
-                                   reverse=True)
-    
     # Criar tabela com cabeçalhos
     st.subheader("Arquivos Processados")
     st.caption("📎 = arquivo em cache (pronto para OCR) | 📄 = arquivo não está em cache")
-    
+
+    # Paginação: só as linhas da página atual geram widgets
+    col_size, col_page, col_refresh = st.columns([2, 2, 1])
+    with col_size:
+        page_size = st.selectbox("Itens por página", [10, 20, 50], index=1, key="invoice_page_size")
+    page_count = max(1, -(-len(invoices) // page_size))
+    with col_page:
+        page = st.number_input(f"Página (de {page_count})", min_value=1, max_value=page_count, value=1, key="invoice_page")
+    with col_refresh:
+        st.write("")
+        if st.button("🔄 Atualizar", key="refresh_invoices", use_container_width=True):
+            load_invoice_summaries.clear()
+            st.rerun()
+
     # Cabeçalhos da tabela
     col1, col2, col3, col4 = st.columns([4, 2, 2, 2])
-    
+
     with col1:
         st.markdown("**Nome do Arquivo**")
     with col2:
@@ -606,185 +545,37 @@ else:
         st.markdown("**Data de Criação**")
     with col4:
         st.markdown("**Ações**")
-    
+
     st.divider()
-    
-    # Exibir cada invoice em uma linha da tabela
-    for inv in sorted_unique_invoices:
-        col1, col2, col3, col4 = st.columns([4, 2, 2, 2])
-        
-        with col1:
-            filename = inv.get('filename', 'N/A')
-            # Check if file is in cache
-            is_cached = inv["id"] in st.session_state.get("files_cache", {})
-            cache_indicator = "📎" if is_cached else "📄"
-            st.write(f"{cache_indicator} {filename}")
-        
-        with col2:
-            status = inv.get('status', 'N/A')
-            if status == 'error':
-                st.error(status)
-            elif status == 'llm_sent':
-                st.success(status)
-            elif status == 'ocr_done':
-                st.info(status)
-            else:
-                st.write(status)
-        
-        with col3:
-            created_at = inv.get('created_at', '')
-            if created_at:
-                # Formatar data para exibição mais amigável
-                try:
-                    dt = datetime.datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                    st.write(dt.strftime('%d/%m/%Y %H:%M'))
-                except:
-                    st.write(created_at[:16])  # Mostrar apenas parte da data
-            else:
-                st.write('N/A')
-        
-        with col4:
-            # Usar expander para as ações
-            with st.expander("⚙️ Ações", expanded=False):
-                file_cache = st.session_state.get("files_cache", {}).get(inv["id"])
-                
-                # Botão para visualizar/editar OCR
-                if st.button("📝 Visualizar/Editar OCR", key=f"view_ocr_{inv['id']}", use_container_width=True):
-                    text_val = inv.get("ocr_text") or ""
-                    image_data = inv.get("image_data")
-                    image_mime_type = inv.get("image_mime_type")
-                    show_ocr_dialog(inv["id"], inv.get('filename', 'N/A'), text_val, image_data, image_mime_type)
-                
-                # Botão para visualizar resposta LLM (se disponível)
-                if inv.get("llm_response"):
-                    if st.button("🤖 Ver Resposta LLM", key=f"view_llm_{inv['id']}", use_container_width=True):
-                        llm_resp = inv.get("llm_response")
-                        show_llm_dialog(inv.get('filename', 'N/A'), llm_resp)
-                
-                # Botão para executar OCR
-                if st.button("🔄 Executar OCR", key=f"run_ocr_{inv['id']}", use_container_width=True):
-                    # Debug: log cache status
-                    logger.info(f"OCR solicitado para invoice {inv['id']}, arquivo: {inv.get('filename')}")
-                    logger.info(f"Cache disponível: {file_cache is not None}, Tamanho: {len(file_cache) if file_cache else 0} bytes")
-                    
-                    if file_cache is None:
-                        st.error("⚠️ Arquivo não está em cache. Por favor, faça upload do arquivo novamente usando o campo acima.")
-                        st.info("💡 **Dica**: Mantenha o arquivo selecionado no campo de upload enquanto processa.")
-                    else:
-                        with st.spinner("Processando OCR..."):
-                            try:
-                                text = run_ocr(file_cache, inv["filename"])
-                                update_invoice(inv["id"], status="ocr_done", ocr_text=text, error=None)
-                                st.success(f"✅ OCR concluído: {inv['filename']}")
-                                st.balloons()
-                                # Wait a moment for user to see the message
-                                time.sleep(1)
-                                st.rerun()
-                            except Exception as e:
-                                tb = traceback.format_exc()
-                                logger.error(tb)
-                                update_invoice(inv["id"], status="error", error=str(e))
-                                st.error(f"❌ OCR falhou: {e}")
-                
-                # Botão para enviar para LLM
-                if st.button("🚀 Enviar para LLM", key=f"send_llm_{inv['id']}", use_container_width=True):
-                    text_val = inv.get("ocr_text") or ""
-                    if not text_val:
-                        st.warning("⚠️ Texto OCR vazio. Execute o OCR primeiro.")
-                    else:
-                        with st.spinner("Enviando para LLM..."):
-                            try:
-                                client = LLMClient()
-                                prompt = (
-                                    "Segue o texto OCR de uma nota fiscal emitida no Brasil de acordo com as regras vigentes. Extraia os principais campos (emitente, CNPJ/CPF, "
-                                    "data, itens, valores, impostos) e retorne em JSON bem estruturado de acordo com o schema abaixo, com campos ausentes como null. "
-                                    "Para campos de endereço, caso a informação não esteja presente no texto OCR ou seja incompleta ou seja inválida, retorne null. "
-                                    "O seu retorno deve ser apenas o JSON, sem nenhum outro texto adicional. É extremamente importante que você retorne APENAS o JSON, sem nenhum outro texto adicional."
-                                    "Use exatamente o formato definido no schema abaixo:\n\n"
-                                    "JSON Schema:\n"
-                                    "{\n"
-                                    '  "$schema": "https://json-schema.org/draft/2020-12/schema",\n'
-                                    '  "title": "NotaFiscalSchema",\n'
-                                    '  "type": "object",\n'
-                                    '  "properties": {\n'
-                                    '    "estabelecimento": {\n'
-                                    '      "type": "object",\n'
-                                    '      "properties": {\n'
-                                    '        "nome": { "type": "string" },\n'
-                                    '        "cnpj": { "type": "string" },\n'
-                                    '        "telefone": { "type": "string" },\n'
-                                    '        "inscricao_estadual": { "type": "string" },\n'
-                                    '        "endereco": {\n'
-                                    '          "type": "object",\n'
-                                    '          "properties": {\n'
-                                    '            "logradouro": { "type": "string" },\n'
-                                    '            "bairro": { "type": "string" },\n'
-                                    '            "cidade": { "type": "string" },\n'
-                                    '            "estado": { "type": "string" }\n'
-                                    '          },\n'
-                                    '          "required": ["logradouro", "bairro", "cidade", "estado"]\n'
-                                    '        }\n'
-                                    '      },\n'
-                                    '      "required": ["nome", "cnpj", "telefone", "inscricao_estadual", "endereco"]\n'
-                                    '    },\n'
-                                    '    "nota_fiscal": {\n'
-                                    '      "type": "object",\n'
-                                    '      "properties": {\n'
-                                    '        "tipo": { "type": "string" },\n'
-                                    '        "numero": { "type": "string" },\n'
-                                    '        "serie": { "type": "string" },\n'
-                                    '        "data_emissao": { "type": "string", "format": "date-time" },\n'
-                                    '        "chave_acesso": { "type": "string" },\n'
-                                    '        "protocolo_autorizacao": { "type": "string" },\n'
-                                    '        "consumidor": { "type": "string" }\n'
-                                    '      },\n'
-                                    '      "required": ["tipo", "numero", "serie", "data_emissao", "chave_acesso", "protocolo_autorizacao", "consumidor"]\n'
-                                    '    },\n'
-                                    '    "itens": {\n'
-                                    '      "type": "array",\n'
-                                    '      "items": {\n'
-                                    '        "type": "object",\n'
-                                    '        "properties": {\n'
-                                    '          "codigo": { "type": ["string", "null"] },\n'
-                                    '          "descricao": { "type": "string" },\n'
-                                    '          "quantidade": { "type": "number" },\n'
-                                    '          "valor_unitario": { "type": "number" },\n'
-                                    '          "valor_total": { "type": "number" }\n'
-                                    '        },\n'
-                                    '        "required": ["descricao", "quantidade", "valor_unitario", "valor_total"]\n'
-                                    '      }\n'
-                                    '    },\n'
-                                    '    "totais": {\n'
-                                    '      "type": "object",\n'
-                                    '      "properties": {\n'
-                                    '        "valor_total": { "type": "number" },\n'
-                                    '        "forma_pagamento": { "type": "string" },\n'
-                                    '        "valor_pago": { "type": "number" }\n'
-                                    '      },\n'
-                                    '      "required": ["valor_total", "forma_pagamento", "valor_pago"]\n'
-                                    '    }\n'
-                                    '  },\n'
-                                    '  "required": ["estabelecimento", "nota_fiscal", "itens", "totais"]\n'
-                                    "}\n\n"
-                                    f"Texto OCR:\n{text_val}"
-                                )
-                                resp = client.send(prompt)
-                                update_invoice(inv["id"], status="llm_sent", llm_response=resp, error=None)
-                                st.success("✅ Envio para LLM concluído!")
-                                # Wait a moment for user to see the message
-                                time.sleep(1)
-                                st.rerun()
-                            except Exception as e:
-                                tb = traceback.format_exc()
-                                logger.error(tb)
-                                update_invoice(inv["id"], status="error", error=str(e))
-                                st.error(f"❌ LLM falhou: {e}")
-        
-        
-        # Exibir erro se houver
-        err = inv.get("error")
-        if err:
-            st.error(f"Erro registrado: {err}")
-        
-        st.divider()
 
+    # Exibir cada invoice da página em uma linha da tabela
+    for inv in invoices[(page - 1) * page_size:page * page_size]:
+        invoice_row(inv)
+
+# Relatórios agregados no banco (RPCs sobre as tabelas normalizadas)
+st.subheader("Relatórios")
+if st.toggle("📊 Mostrar relatórios", key="show_reports"):
+    col_from, col_to = st.columns(2)
+    with col_from:
+        date_from = st.date_input("Emitidas a partir de", value=None, key="report_from", format="DD/MM/YYYY")
+    with col_to:
+        date_to = st.date_input("Emitidas até", value=None, key="report_to", format="DD/MM/YYYY")
+    period = {
+        "date_from": date_from.isoformat() if date_from else None,
+        # date_to is inclusive in the UI; the RPCs use an exclusive upper bound
+        "date_to": (date_to + datetime.timedelta(days=1)).isoformat() if date_to else None,
+    }
+    try:
+        col_spend, col_products = st.columns(2)
+        with col_spend:
+            st.markdown("**Gastos por estabelecimento**")
+            st.dataframe(spend_by_establishment(**period), use_container_width=True, hide_index=True)
+        with col_products:
+            st.markdown("**Produtos mais comprados**")
+            st.dataframe(top_products(**period), use_container_width=True, hide_index=True)
+    except Exception as e:
+        st.error(f"Erro ao carregar relatórios: {e}")
+
+if PROFILE_STARTUP:
+    profile = record_startup_profile(logger, _run_started)
+    st.sidebar.caption(f"⏱️ Execução {profile['run']} ({profile['kind']}): {profile['duration_ms']} ms")
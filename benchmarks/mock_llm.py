@@ -0,0 +1,202 @@
+"""
+Local mock LLM server for the benchmark suite.
+
+Answers OpenAI-style ``/v1/chat/completions`` and Anthropic-style
+``/v1/messages`` requests. Instead of a model it runs a deterministic,
+rule-based extractor over the OCR text embedded in the prompt, so the
+field-level accuracy of a run depends only on OCR quality and on the
+response parsing in extraction.py. An optional fixed latency emulates the
+WAN round trip of a hosted provider; with ``"stream": true`` the response
+is sent as server-sent events in small chunks, the first one after a fifth
+of that latency and the rest spread over the remainder.
+"""
+import json, re, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+_OCR_MARKER = "Texto OCR:\n"
+
+_CNPJ_RE = re.compile(r"\d{2}\.?\d{3}\.?\d{3}\s*/\s*\d{4}\s*-?\s*\d{2}")
+_CHAVE_RE = re.compile(r"(?<!\d)(?:\d[ \t]*){43}\d(?!\d)")
+_DATE_RE = re.compile(r"(\d{2})/(\d{2})/(\d{4}|\d{2})(?:\s+(\d{2}:\d{2}(?::\d{2})?))?")
+_NUMERO_RE = re.compile(r"(?:N[úu]mero(?: da NFS-e)?|NFC-e\s*n\S*|N[ºo°])\s*:?\s*(\d+)", re.IGNORECASE)
+_SERIE_RE = re.compile(r"S[ée]rie\s*:?\s*([0-9A-Z]+)", re.IGNORECASE)
+_MONEY_RE = re.compile(r"\d{1,3}(?:\.\d{3})*,\d{2}")
+_TOTAL_RE = re.compile(r"valor\s+total|total\s+a\s+pagar", re.IGNORECASE)
+
+def _to_float(value: str):
+    try:
+        return float(value.replace(".", "").replace(",", "."))
+    except ValueError:
+        return None
+
+def _find_total(lines: list):
+    for i, line in enumerate(lines):
+        if not _TOTAL_RE.search(line):
+            continue
+        # The amount is either on the same line or on one of the next ones
+        for candidate in lines[i:i + 3]:
+            amounts = _MONEY_RE.findall(candidate)
+            if amounts:
+                return _to_float(amounts[-1])
+    return None
+
+def _find_date(text: str):
+    emission = re.search(r"Emiss\S*", text, re.IGNORECASE)
+    match = _DATE_RE.search(text, emission.start()) if emission else None
+    match = match or _DATE_RE.search(text)
+    if not match:
+        return None
+    day, month, year, clock = match.groups()
+    if len(year) == 2:
+        year = f"20{year}"
+    return f"{year}-{month}-{day}T{clock or '00:00:00'}"
+
+def extract_fields(ocr_text: str) -> dict:
+    """Rule-based extraction of NotaFiscalSchema fields from OCR text"""
+    lines = [l for l in ocr_text.splitlines() if l.strip()]
+    cnpj = _CNPJ_RE.search(ocr_text)
+    chave = _CHAVE_RE.search(ocr_text)
+    numero = _NUMERO_RE.search(ocr_text)
+    serie = _SERIE_RE.search(ocr_text)
+    return {
+        "estabelecimento": {
+            "nome": lines[0].strip() if lines else None,
+            "cnpj": re.sub(r"\s", "", cnpj.group(0)) if cnpj else None,
+            "telefone": None,
+            "inscricao_estadual": None,
+            "endereco": None,
+        },
+        "nota_fiscal": {
+            "tipo": None,
+            "numero": numero.group(1) if numero else None,
+            "serie": serie.group(1) if serie else None,
+            "data_emissao": _find_date(ocr_text),
+            "chave_acesso": re.sub(r"\s", "", chave.group(0)) if chave else None,
+            "protocolo_autorizacao": None,
+            "consumidor": None,
+        },
+        "itens": [],
+        "totais": {
+            "valor_total": _find_total(lines),
+            "forma_pagamento": None,
+            "valor_pago": None,
+        },
+    }
+
+def _prompt_from_messages(messages: list) -> str:
+    for message in reversed(messages or []):
+        if message.get("role") == "user":
+            content = message.get("content")
+            if isinstance(content, list):
+                return "".join(b.get("text", "") for b in content if isinstance(b, dict))
+            return content or ""
+    return ""
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_events(self, events: list):
+        """Server-sent events; the connection is closed at the end instead of using a Content-Length"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        delay = self.latency * 0.8 / max(1, len(events) - 1)
+        time.sleep(self.latency * 0.2)
+        try:
+            for n, (name, data) in enumerate(events):
+                if n:
+                    time.sleep(delay)
+                head = f"event: {name}\n" if name else ""
+                body = data if isinstance(data, str) else json.dumps(data)
+                self.wfile.write(f"{head}data: {body}\n\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped the generation early
+            pass
+
+    def _stream(self, path: str, model: str, content: str):
+        chunks = [content[i:i + 16] for i in range(0, len(content), 16)]
+        if path.endswith("/chat/completions"):
+            events = [(None, {"object": "chat.completion.chunk", "model": model,
+                              "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]})
+                      for chunk in chunks]
+            events.append((None, {"object": "chat.completion.chunk", "model": model,
+                                  "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+            events.append((None, "[DONE]"))
+        else:
+            events = [("message_start", {"type": "message_start", "message": {"model": model}}),
+                      ("content_block_start", {"type": "content_block_start", "index": 0,
+                                               "content_block": {"type": "text", "text": ""}})]
+            events += [("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                "delta": {"type": "text_delta", "text": chunk}})
+                       for chunk in chunks]
+            events += [("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                       ("message_stop", {"type": "message_stop"})]
+        self._send_events(events)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        prompt = _prompt_from_messages(request.get("messages"))
+        _, _, ocr_text = prompt.partition(_OCR_MARKER)
+        content = json.dumps(extract_fields(ocr_text), ensure_ascii=False)
+
+        path = urlsplit(self.path).path
+        if request.get("stream") and path.endswith(("/chat/completions", "/messages")):
+            return self._stream(path, request.get("model"), content)
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path.endswith("/chat/completions"):
+            return self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            })
+        if path.endswith("/messages"):
+            return self._send_json(200, {
+                "id": f"msg_{uuid.uuid4().hex}",
+                "type": "message",
+                "role": "assistant",
+                "model": request.get("model"),
+                "content": [{"type": "text", "text": content}],
+                "stop_reason": "end_turn",
+            })
+        self._send_json(404, {"error": {"message": f"unknown path {path}"}})
+
+class MockLLMServer:
+    """Threaded mock LLM server bound to 127.0.0.1 on an ephemeral port"""
+
+    def __init__(self, latency_ms: float = 0, host: str = "127.0.0.1", port: int = 0):
+        handler = type("Handler", (_Handler,), {"latency": latency_ms / 1000.0})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
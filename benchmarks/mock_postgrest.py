@@ -0,0 +1,180 @@
+"""
+Local PostgREST-compatible stand-in for Supabase used by the benchmark suite.
+
+Only the subset of the REST API used by storage.py is implemented: insert
+and upsert (POST, ?on_conflict=col), update (PATCH ?col=eq.value), delete,
+select (GET with eq filters, order and limit) and RPC calls to functions
+registered with MockPostgREST.register_rpc(). Rows live in memory and are
+lost when the server stops.
+"""
+import json, threading, uuid, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+class _Store:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.functions = {}
+
+    def table(self, name: str) -> list:
+        return self.tables.setdefault(name, [])
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+def _matches(row: dict, filters: list) -> bool:
+    for col, expr in filters:
+        op, _, value = expr.partition(".")
+        if op == "eq" and str(row.get(col)) != value:
+            return False
+        if op == "is" and value == "null" and row.get(col) is not None:
+            return False
+    return True
+
+def _split_query(query: str):
+    filters, options = [], {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        if key in ("select", "order", "limit", "offset", "on_conflict", "columns"):
+            options[key] = value
+        else:
+            filters.append((key, value))
+    return filters, options
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _table_name(self):
+        path = urlsplit(self.path).path
+        prefix = "/rest/v1/"
+        if not path.startswith(prefix):
+            return None
+        return path[len(prefix):]
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _send_json(self, status: int, payload):
+        if "return=minimal" in (self.headers.get("Prefer") or ""):
+            self.send_response(204 if status == 200 else status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        name = self._table_name()
+        if not name:
+            return self._send_json(404, {"message": "not found"})
+        payload = self._read_json()
+        if name.startswith("rpc/"):
+            function = self.store.functions.get(name[len("rpc/"):])
+            if function is None:
+                return self._send_json(404, {"message": f"function {name} not found"})
+            with self.store.lock:
+                result = function(self.store, **(payload or {}))
+            return self._send_json(200, result)
+
+        _, options = _split_query(urlsplit(self.path).query)
+        conflict_cols = [c for c in (options.get("on_conflict") or "").split(",") if c]
+        rows = payload if isinstance(payload, list) else [payload]
+        created = []
+        with self.store.lock:
+            table = self.store.table(name)
+            for row in rows:
+                row = dict(row)
+                existing = None
+                if conflict_cols:
+                    existing = next((r for r in table if all(r.get(c) == row.get(c) for c in conflict_cols)), None)
+                if existing is not None:
+                    existing.update(row)
+                    created.append(dict(existing))
+                    continue
+                row.setdefault("id", str(uuid.uuid4()))
+                row.setdefault("created_at", _now())
+                row.setdefault("updated_at", row["created_at"])
+                table.append(row)
+                created.append(dict(row))
+        self._send_json(201, created)
+
+    def do_DELETE(self):
+        name = self._table_name()
+        if not name:
+            return self._send_json(404, {"message": "not found"})
+        filters, _ = _split_query(urlsplit(self.path).query)
+        with self.store.lock:
+            table = self.store.table(name)
+            deleted = [r for r in table if _matches(r, filters)]
+            table[:] = [r for r in table if not _matches(r, filters)]
+        self._send_json(200, deleted)
+
+    def do_PATCH(self):
+        name = self._table_name()
+        if not name:
+            return self._send_json(404, {"message": "not found"})
+        filters, _ = _split_query(urlsplit(self.path).query)
+        fields = self._read_json() or {}
+        updated = []
+        with self.store.lock:
+            for row in self.store.table(name):
+                if _matches(row, filters):
+                    row.update(fields)
+                    updated.append(dict(row))
+        self._send_json(200, updated)
+
+    def do_GET(self):
+        name = self._table_name()
+        if not name:
+            return self._send_json(404, {"message": "not found"})
+        filters, options = _split_query(urlsplit(self.path).query)
+        with self.store.lock:
+            rows = [dict(r) for r in self.store.table(name) if _matches(r, filters)]
+        order = options.get("order")
+        if order:
+            col, _, direction = order.partition(".")
+            rows.sort(key=lambda r: str(r.get(col) or ""), reverse=direction.startswith("desc"))
+        offset = int(options.get("offset") or 0)
+        limit = options.get("limit")
+        rows = rows[offset:offset + int(limit)] if limit else rows[offset:]
+        self._send_json(200, rows)
+
+class MockPostgREST:
+    """Threaded in-memory PostgREST server bound to 127.0.0.1 on an ephemeral port"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        handler = type("Handler", (_Handler,), {"store": _Store()})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def store(self) -> _Store:
+        return self.server.RequestHandlerClass.store
+
+    def register_rpc(self, name: str, function):
+        """Expose function(store, **params) as POST /rest/v1/rpc/<name>"""
+        self.store.functions[name] = function
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
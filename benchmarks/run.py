@@ -0,0 +1,320 @@
+"""
+End-to-end benchmark for the OCR + LLM extraction pipeline.
+
+Runs every document in the corpus (``notas_teste/`` by default) through the
+same steps as the automatic processing in app.py -- upload, run_ocr_result, LLM
+extraction and persistence -- against a local mock LLM server and a local
+PostgREST stand-in, so runs are reproducible and need no credentials.
+
+Reports docs/sec, per-stage timing, peak RSS and field-level accuracy
+against ``benchmarks/ground_truth.json``. Results are written as JSON and
+can be saved as a baseline and diffed against later runs:
+
+    python -m benchmarks.run --save-baseline
+    python -m benchmarks.run --compare
+"""
+import os, sys, json, time, argparse, resource, platform, datetime, statistics, re
+from dotenv import load_dotenv
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.mock_llm import MockLLMServer
+from benchmarks.mock_postgrest import MockPostgREST
+
+DEFAULT_CORPUS = os.path.join(ROOT_DIR, "notas_teste")
+DEFAULT_GROUND_TRUTH = os.path.join(BENCH_DIR, "ground_truth.json")
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, "results", "latest.json")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+STAGES = ["upload", "ocr", "ocr_save", "llm_ttfb", "llm", "llm_save", "parse", "ingest"]
+
+def _peak_rss_mb(who) -> float:
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+def _lookup(data, dotted: str):
+    for key in dotted.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+def _normalize(field: str, value):
+    """Bring expected and extracted values to a comparable form"""
+    if value is None:
+        return None
+    if field.endswith("valor_total"):
+        if isinstance(value, str):
+            value = value.replace("R$", "").strip()
+            if "," in value:
+                value = value.replace(".", "").replace(",", ".")
+        try:
+            return round(float(value), 2)
+        except (TypeError, ValueError):
+            return None
+    value = str(value).strip()
+    if field.endswith("cnpj") or field.endswith("chave_acesso"):
+        return re.sub(r"\D", "", value) or None
+    if field.endswith("data_emissao"):
+        match = re.search(r"(\d{4})-(\d{2})-(\d{2})", value)
+        if match:
+            return "-".join(match.groups())
+        match = re.search(r"(\d{2})/(\d{2})/(\d{4}|\d{2})", value)
+        if match:
+            day, month, year = match.groups()
+            return f"{'20' + year if len(year) == 2 else year}-{month}-{day}"
+        return value
+    if field.endswith("numero") or field.endswith("serie"):
+        return value.upper().lstrip("0") or "0"
+    return value
+
+def score_fields(expected: dict, extracted) -> dict:
+    """Compare extracted data with the ground truth; fields with null truth are skipped"""
+    scores = {}
+    for field, truth in (expected or {}).items():
+        if truth is None:
+            continue
+        got = _lookup(extracted, field) if isinstance(extracted, dict) else None
+        scores[field] = _normalize(field, got) == _normalize(field, truth)
+    return scores
+
+def _summarize(samples: list) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+    return {
+        "count": len(samples),
+        "total_s": round(sum(samples), 4),
+        "mean_ms": round(statistics.mean(samples) * 1000, 2),
+        "p50_ms": round(statistics.median(samples) * 1000, 2),
+        "p95_ms": round(p95 * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+def _mean_confidence(documents: list):
+    values = [d["ocr_confidence"]["mean"] for d in documents if d.get("ocr_confidence", {}).get("words")]
+    return round(statistics.mean(values), 1) if values else None
+
+def _corpus_files(corpus: str, limit: int = None) -> list:
+    from ocr import SUPPORTED_DOC_EXT
+    names = sorted(n for n in os.listdir(corpus) if os.path.splitext(n)[1].lower() in SUPPORTED_DOC_EXT)
+    return names[:limit] if limit else names
+
+def run_benchmark(corpus: str, ground_truth: dict, repeat: int = 1, limit: int = None,
+                  provider: str = None, llm_latency_ms: float = 0, live_llm: bool = False,
+                  stream: bool = False) -> dict:
+    postgrest = MockPostgREST().start()
+    llm_server = None if live_llm else MockLLMServer(latency_ms=llm_latency_ms).start()
+    try:
+        # Configuration is cached per process, so point it at the stand-ins first
+        os.environ["SUPABASE_URL"] = postgrest.url
+        os.environ["SUPABASE_API_KEY"] = "benchmark"
+        os.environ["SUPABASE_TABLE"] = "invoices"
+        if provider or llm_server:
+            os.environ["LLM_PROVIDER"] = provider or "openai"
+        if llm_server:
+            os.environ["OPENAI_BASE_URL"] = llm_server.url
+            os.environ["ANTHROPIC_BASE_URL"] = llm_server.url
+            os.environ["LOCAL_LLM_BASE_URL"] = llm_server.url
+            os.environ["OPENAI_API_KEY"] = "benchmark"
+            os.environ["ANTHROPIC_API_KEY"] = "benchmark"
+
+        import storage, llm_agent, ocr
+        storage._config.cache_clear()
+        llm_agent.get_llm_client.cache_clear()
+        ocr._pdf_settings.cache_clear()
+        ocr._reocr_settings.cache_clear()
+        from ocr import run_ocr_result
+        from llm_agent import get_llm_client
+        from storage import create_invoice, update_invoice, upload_invoice_file, save_parsed_invoice
+        from ingest import ingest_upload
+        from extraction import build_extraction_prompt, extract_json_from_llm_response, parse_invoice
+
+        files = _corpus_files(corpus, limit)
+        timings = {stage: [] for stage in STAGES}
+        documents = []
+        field_hits, field_totals = {}, {}
+
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for name in files:
+                with open(os.path.join(corpus, name), "rb") as fh:
+                    ingested = ingest_upload(fh, name)
+                file_bytes = ingested.buffer
+                doc = {"filename": name, "bytes": ingested.size, "stages_ms": {}}
+                stage_start = time.perf_counter()
+
+                def lap(stage):
+                    nonlocal stage_start
+                    now = time.perf_counter()
+                    timings[stage].append(now - stage_start)
+                    doc["stages_ms"][stage] = round((now - stage_start) * 1000, 2)
+                    stage_start = now
+
+                try:
+                    invoice_id = create_invoice(name)["id"]
+                    upload_invoice_file(invoice_id, file_bytes, mime_type=None, filename=name, sha256=ingested.sha256)
+                    lap("upload")
+
+                    ocr_result = run_ocr_result(file_bytes, name)
+                    text = ocr_result.text
+                    doc["ocr_confidence"] = ocr_result.summary()
+                    lap("ocr")
+                    update_invoice(invoice_id, status="ocr_done", ocr_text=text, ocr_confidence=doc["ocr_confidence"], error=None)
+                    lap("ocr_save")
+
+                    if stream:
+                        # llm_ttfb: time until the first streamed chunk (not a lap; llm still covers the whole call)
+                        first_chunk = []
+                        resp = get_llm_client().send(build_extraction_prompt(text),
+                                                     on_delta=lambda delta, content: first_chunk or first_chunk.append(time.perf_counter()))
+                        if first_chunk:
+                            timings["llm_ttfb"].append(first_chunk[0] - stage_start)
+                            doc["stages_ms"]["llm_ttfb"] = round((first_chunk[0] - stage_start) * 1000, 2)
+                    else:
+                        resp = get_llm_client().send(build_extraction_prompt(text))
+                    lap("llm")
+                    update_invoice(invoice_id, status="llm_sent", llm_response=resp, error=None)
+                    lap("llm_save")
+
+                    extracted = extract_json_from_llm_response(resp)
+                    lap("parse")
+                    parsed = parse_invoice(resp)
+                    if parsed:
+                        save_parsed_invoice(invoice_id, parsed)
+                    lap("ingest")
+                except Exception as e:
+                    doc["error"] = str(e)
+                    extracted = None
+
+                scores = score_fields(ground_truth.get(name), extracted)
+                doc["fields"] = scores
+                for field, ok in scores.items():
+                    field_totals[field] = field_totals.get(field, 0) + 1
+                    field_hits[field] = field_hits.get(field, 0) + int(ok)
+                documents.append(doc)
+        elapsed = time.perf_counter() - started
+    finally:
+        postgrest.stop()
+        if llm_server:
+            llm_server.stop()
+
+    total_fields = sum(field_totals.values())
+    return {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "llm": (f"live:{os.environ.get('LLM_PROVIDER', 'openai')}/{os.environ.get('LLM_MODEL', '')}"
+                    if live_llm else f"mock:{provider or 'openai'}"),
+            "llm_latency_ms": llm_latency_ms,
+            "stream": stream,
+        },
+        "documents": len(documents),
+        "errors": sum(1 for d in documents if "error" in d),
+        "elapsed_s": round(elapsed, 3),
+        "docs_per_sec": round(len(documents) / elapsed, 4) if elapsed else None,
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+        "peak_rss_children_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+        "stages": {stage: _summarize(samples) for stage, samples in timings.items()},
+        "ocr_mean_confidence": _mean_confidence(documents),
+        "accuracy": {
+            "overall": round(sum(field_hits.values()) / total_fields, 4) if total_fields else None,
+            "fields": {f: round(field_hits[f] / field_totals[f], 4) for f in sorted(field_totals)},
+        },
+        "per_document": documents,
+    }
+
+def _delta(label: str, old, new, higher_is_better: bool) -> str:
+    if old is None or new is None:
+        return f"  {label:<34} {old!s:>12} -> {new!s:>12}"
+    diff = new - old
+    pct = (diff / old * 100) if old else 0.0
+    better = (diff > 0) == higher_is_better if diff else None
+    mark = "" if better is None else (" (melhor)" if better else " (pior)")
+    return f"  {label:<34} {old:>12} -> {new:>12}  {pct:+.1f}%{mark}"
+
+def compare(baseline: dict, current: dict) -> str:
+    """Human-readable diff between two benchmark results"""
+    lines = ["Comparação com baseline:"]
+    lines.append(_delta("docs/sec", baseline.get("docs_per_sec"), current.get("docs_per_sec"), True))
+    lines.append(_delta("peak RSS (MB)", baseline.get("peak_rss_mb"), current.get("peak_rss_mb"), False))
+    lines.append(_delta("OCR mean confidence", baseline.get("ocr_mean_confidence"), current.get("ocr_mean_confidence"), True))
+    lines.append(_delta("peak RSS children (MB)", baseline.get("peak_rss_children_mb"), current.get("peak_rss_children_mb"), False))
+    for stage in STAGES:
+        old = baseline.get("stages", {}).get(stage, {}).get("mean_ms")
+        new = current.get("stages", {}).get(stage, {}).get("mean_ms")
+        lines.append(_delta(f"{stage} mean (ms)", old, new, False))
+    old_acc, new_acc = baseline.get("accuracy", {}), current.get("accuracy", {})
+    lines.append(_delta("accuracy overall", old_acc.get("overall"), new_acc.get("overall"), True))
+    for field in sorted(set(old_acc.get("fields", {})) | set(new_acc.get("fields", {}))):
+        lines.append(_delta(f"accuracy {field}", old_acc.get("fields", {}).get(field),
+                            new_acc.get("fields", {}).get(field), True))
+    return "\n".join(lines)
+
+def _print_report(result: dict):
+    print(f"Documentos: {result['documents']} (erros: {result['errors']})  "
+          f"tempo: {result['elapsed_s']}s  docs/sec: {result['docs_per_sec']}")
+    print(f"Peak RSS: {result['peak_rss_mb']} MB (filhos: {result['peak_rss_children_mb']} MB)")
+    for stage, stats in result["stages"].items():
+        if stats.get("count"):
+            print(f"  {stage:<10} mean {stats['mean_ms']:>9} ms  p95 {stats['p95_ms']:>9} ms")
+    print(f"Confiança média do OCR: {result.get('ocr_mean_confidence')}")
+    print(f"Acurácia geral: {result['accuracy']['overall']}")
+    for field, acc in result["accuracy"]["fields"].items():
+        print(f"  {field:<28} {acc}")
+
+def _write_json(path: str, data: dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(data, fh, indent=2, ensure_ascii=False)
+        fh.write("\n")
+
+def main(argv=None):
+    # Keys and provider settings for --live-llm; the SUPABASE_* and mock LLM
+    # variables set by run_benchmark still take precedence
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline OCR + LLM")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--ground-truth", default=DEFAULT_GROUND_TRUTH)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--provider", choices=["openai", "anthropic", "local"], default=None,
+                        help="API format emulated by the mock LLM server (with --live-llm: provider to call)")
+    parser.add_argument("--llm-latency-ms", type=float, default=0,
+                        help="artificial latency added by the mock LLM server")
+    parser.add_argument("--live-llm", action="store_true",
+                        help="use the provider configured in .env instead of the mock server")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream the LLM response (SSE) and report time to first chunk (llm_ttfb)")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, default=None)
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, default=None)
+    args = parser.parse_args(argv)
+
+    with open(args.ground_truth, encoding="utf-8") as fh:
+        ground_truth = json.load(fh)
+
+    result = run_benchmark(args.corpus, ground_truth, repeat=args.repeat, limit=args.limit,
+                           provider=args.provider, llm_latency_ms=args.llm_latency_ms,
+                           live_llm=args.live_llm, stream=args.stream)
+    _print_report(result)
+    _write_json(args.output, result)
+    print(f"Resultado salvo em {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fh:
+            print(compare(json.load(fh), result))
+    if args.save_baseline:
+        _write_json(args.save_baseline, result)
+        print(f"Baseline salvo em {args.save_baseline}")
+
+if __name__ == "__main__":
+    main()
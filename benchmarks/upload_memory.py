@@ -0,0 +1,99 @@
+"""
+Peak RSS of batch uploads: the previous upload path (f.read() + base64 string
++ json.dumps payload + bytes kept in files_cache) against ingest_upload() +
+storage.upload_invoice_file(), which keep a single copy of each file.
+
+Each mode runs in a fresh subprocess that first builds the batch as in-memory
+uploads (like Streamlit's UploadedFile objects), records its peak RSS, then
+uploads every file to the local PostgREST stand-in (running in another
+process, so the rows it stores are not counted) and records the peak again:
+
+    python -m benchmarks.upload_memory --files 5 --size-mb 20
+"""
+import io, os, sys, json, time, base64, argparse, resource, subprocess, multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.run import _peak_rss_mb
+from benchmarks.mock_postgrest import MockPostgREST
+
+MODES = ["legacy", "streaming"]
+
+def _upload_batch(mode: str, files: int, size_mb: float) -> dict:
+    """Runs inside the subprocess; SUPABASE_* already point at the stand-in"""
+    from storage import create_invoice, update_invoice, upload_invoice_file
+    from ingest import ingest_upload
+
+    uploads = []
+    for i in range(files):
+        # Like Streamlit's UploadedFile: a BytesIO over the received bytes
+        upload = io.BytesIO(os.urandom(int(size_mb * 1024 * 1024)))
+        upload.name = f"nota_{i}.pdf"
+        uploads.append(upload)
+    before = _peak_rss_mb(resource.RUSAGE_SELF)
+
+    files_cache = {}
+    started = time.perf_counter()
+    for f in uploads:
+        invoice_id = create_invoice(f.name)["id"]
+        if mode == "legacy":
+            file_bytes = f.read()
+            file_base64 = base64.b64encode(file_bytes).decode("utf-8")
+            update_invoice(invoice_id, image_data=file_base64, image_mime_type="application/pdf", image_filename=f.name)
+        else:
+            ingested = ingest_upload(f)
+            file_bytes = ingested.buffer
+            upload_invoice_file(invoice_id, file_bytes, mime_type="application/pdf",
+                                filename=f.name, sha256=ingested.sha256)
+        files_cache[invoice_id] = file_bytes
+    elapsed = time.perf_counter() - started
+
+    after = _peak_rss_mb(resource.RUSAGE_SELF)
+    return {"mode": mode, "files": files, "size_mb": size_mb, "seconds": round(elapsed, 2),
+            "peak_rss_before_mb": before, "peak_rss_mb": after, "upload_overhead_mb": round(after - before, 1)}
+
+def _serve(conn):
+    postgrest = MockPostgREST().start()
+    conn.send(postgrest.url)
+    conn.recv()
+    postgrest.stop()
+
+def run(files: int, size_mb: float, modes=MODES) -> list:
+    results = []
+    for mode in modes:
+        # The stand-in runs in its own process: the rows it keeps would otherwise grow this
+        # process, and a forked child starts its ru_maxrss from its parent's RSS
+        conn, child_conn = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve, args=(child_conn,), daemon=True)
+        server.start()
+        env = {**os.environ, "SUPABASE_URL": conn.recv(), "SUPABASE_API_KEY": "benchmark", "SUPABASE_TABLE": "invoices"}
+        try:
+            out = subprocess.run([sys.executable, "-m", "benchmarks.upload_memory", "--child", mode,
+                                  "--files", str(files), "--size-mb", str(size_mb)],
+                                 cwd=ROOT_DIR, env=env, check=True, capture_output=True, text=True)
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        finally:
+            conn.send("stop")
+            server.join()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pico de memória (RSS) no upload em lote")
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--size-mb", type=float, default=20)
+    parser.add_argument("--mode", choices=MODES, action="append", default=None)
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(_upload_batch(args.child, args.files, args.size_mb)))
+        return
+    for result in run(args.files, args.size_mb, args.mode or MODES):
+        print(f"{result['mode']:>9}: {result['files']} x {result['size_mb']:g} MB em {result['seconds']:.2f}s, "
+              f"pico RSS {result['peak_rss_mb']:.1f} MB (+{result['upload_overhead_mb']:.1f} MB sobre os uploads em memória)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+import json, re, datetime
+
+# Prompt sent to the LLM; the OCR text is appended by build_extraction_prompt()
+EXTRACTION_PROMPT = (
+    "Segue o texto OCR de uma nota fiscal emitida no Brasil de acordo com as regras vigentes. Extraia os principais campos (emitente, CNPJ/CPF, "
+    "data, itens, valores, impostos) e retorne em JSON bem estruturado de acordo com o schema abaixo, com campos ausentes como null. "
+    "Para campos de endereço, caso a informação não esteja presente no texto OCR ou seja incompleta ou seja inválida, retorne null. "
+    "O seu retorno deve ser apenas o JSON, sem nenhum outro texto adicional. É extremamente importante que você retorne APENAS o JSON, sem nenhum outro texto adicional."
+    "Use exatamente o formato definido no schema abaixo:\n\n"
+    "JSON Schema:\n"
+    "{\n"
+    '  "$schema": "https://json-schema.org/draft/2020-12/schema",\n'
+    '  "title": "NotaFiscalSchema",\n'
+    '  "type": "object",\n'
+    '  "properties": {\n'
+    '    "estabelecimento": {\n'
+    '      "type": "object",\n'
+    '      "properties": {\n'
+    '        "nome": { "type": "string" },\n'
+    '        "cnpj": { "type": "string" },\n'
+    '        "telefone": { "type": "string" },\n'
+    '        "inscricao_estadual": { "type": "string" },\n'
+    '        "endereco": {\n'
+    '          "type": "object",\n'
+    '          "properties": {\n'
+    '            "logradouro": { "type": "string" },\n'
+    '            "bairro": { "type": "string" },\n'
+    '            "cidade": { "type": "string" },\n'
+    '            "estado": { "type": "string" }\n'
+    '          },\n'
+    '          "required": ["logradouro", "bairro", "cidade", "estado"]\n'
+    '        }\n'
+    '      },\n'
+    '      "required": ["nome", "cnpj", "telefone", "inscricao_estadual", "endereco"]\n'
+    '    },\n'
+    '    "nota_fiscal": {\n'
+    '      "type": "object",\n'
+    '      "properties": {\n'
+    '        "tipo": { "type": "string" },\n'
+    '        "numero": { "type": "string" },\n'
+    '        "serie": { "type": "string" },\n'
+    '        "data_emissao": { "type": "string", "format": "date-time" },\n'
+    '        "chave_acesso": { "type": "string" },\n'
+    '        "protocolo_autorizacao": { "type": "string" },\n'
+    '        "consumidor": { "type": "string" }\n'
+    '      },\n'
+    '      "required": ["tipo", "numero", "serie", "data_emissao", "chave_acesso", "protocolo_autorizacao", "consumidor"]\n'
+    '    },\n'
+    '    "itens": {\n'
+    '      "type": "array",\n'
+    '      "items": {\n'
+    '        "type": "object",\n'
+    '        "properties": {\n'
+    '          "codigo": { "type": ["string", "null"] },\n'
+    '          "descricao": { "type": "string" },\n'
+    '          "quantidade": { "type": "number" },\n'
+    '          "valor_unitario": { "type": "number" },\n'
+    '          "valor_total": { "type": "number" }\n'
+    '        },\n'
+    '        "required": ["descricao", "quantidade", "valor_unitario", "valor_total"]\n'
+    '      }\n'
+    '    },\n'
+    '    "totais": {\n'
+    '      "type": "object",\n'
+    '      "properties": {\n'
+    '        "valor_total": { "type": "number" },\n'
+    '        "forma_pagamento": { "type": "string" },\n'
+    '        "valor_pago": { "type": "number" }\n'
+    '      },\n'
+    '      "required": ["valor_total", "forma_pagamento", "valor_pago"]\n'
+    '    }\n'
+    '  },\n'
+    '  "required": ["estabelecimento", "nota_fiscal", "itens", "totais"]\n'
+    "}\n\n"
+)
+
+def build_extraction_prompt(text: str) -> str:
+    """Build the NotaFiscalSchema extraction prompt for the given OCR text"""
+    return f"{EXTRACTION_PROMPT}Texto OCR:\n{text}"
+
+def extract_json_from_llm_response(response_text):
+    """Extract JSON content from LLM response text, focusing on invoice data structure"""
+    if not response_text:
+        return None
+    
+    # If response_text is already a dict, check if it contains invoice data structure
+    if isinstance(response_text, dict):
+        # If it's a complex response with 'raw' field, extract the content
+        if 'raw' in response_text and isinstance(response_text['raw'], dict):
+            raw_content = response_text['raw']
+            if 'choices' in raw_content and len(raw_content['choices']) > 0:
+                message_content = raw_content['choices'][0].get('message', {}).get('content', '')
+                return extract_invoice_json_from_content(message_content)
+        
+        # If it's a complex response with 'content' field, extract from content
+        if 'content' in response_text:
+            return extract_invoice_json_from_content(response_text['content'])
+        
+        # If it already looks like invoice data (has emitente, CNPJ_CPF, etc.), return it
+        if any(key in response_text for key in ['emitente', 'CNPJ_CPF', 'itens', 'valores']):
+            return response_text
+        
+        return response_text
+    
+    # If response_text is not a string, convert it
+    if not isinstance(response_text, str):
+        response_text = str(response_text)
+    
+    return extract_invoice_json_from_content(response_text)
+
+def extract_invoice_json_from_content(content):
+    """Extract invoice JSON from text content"""
+    # Clean the text - remove common LLM prefixes/suffixes
+    cleaned_text = content.strip()
+    
+    # Remove common prefixes that LLMs might add
+    prefixes_to_remove = [
+        "Aqui está a extração e normalização dos dados da nota fiscal em formato JSON:",
+        "Aqui está o JSON:",
+        "Segue o JSON:",
+        "JSON:",
+        "```json",
+        "```",
+        "Resposta:",
+        "Resultado:"
+    ]
+    
+    for prefix in prefixes_to_remove:
+        if cleaned_text.lower().startswith(prefix.lower()):
+            cleaned_text = cleaned_text[len(prefix):].strip()
+    
+    # Remove trailing ``` if present
+    if cleaned_text.endswith("```"):
+        cleaned_text = cleaned_text[:-3].strip()
+    
+    # Remove any text after the JSON (like "Observações:")
+    json_end_pattern = r'\n\nObservações?:'
+    cleaned_text = re.split(json_end_pattern, cleaned_text)[0]
+    
+    # Try to parse the cleaned text as JSON
+    try:
+        parsed_json = json.loads(cleaned_text)
+        # Verify it looks like invoice data
+        if isinstance(parsed_json, dict) and any(key in parsed_json for key in ['emitente', 'CNPJ_CPF', 'itens', 'valores']):
+            return parsed_json
+    except json.JSONDecodeError:
+        pass
+    
+    # Look for JSON objects in the text (more robust pattern)
+    json_pattern = r'\{(?:[^{}]|{[^{}]*})*\}'
+    matches = re.findall(json_pattern, cleaned_text, re.DOTALL)
+    
+    if matches:
+        # Try to parse the largest match (most likely to be the complete JSON)
+        largest_match = max(matches, key=len)
+        try:
+            parsed_json = json.loads(largest_match)
+            # Verify it looks like invoice data
+            if isinstance(parsed_json, dict) and any(key in parsed_json for key in ['emitente', 'CNPJ_CPF', 'itens', 'valores']):
+                return parsed_json
+        except json.JSONDecodeError:
+            # Try all matches
+            for match in matches:
+                try:
+                    parsed_json = json.loads(match)
+                    # Verify it looks like invoice data
+                    if isinstance(parsed_json, dict) and any(key in parsed_json for key in ['emitente', 'CNPJ_CPF', 'itens', 'valores']):
+                        return parsed_json
+                except json.JSONDecodeError:
+                    continue
+    
+    # If no valid invoice JSON found, return a structured error response
+    return {"error": "Resposta não contém JSON válido de nota fiscal", "raw_response": content[:200] + "..." if len(content) > 200 else content}
+
+def conforms_to_schema(data) -> bool:
+    """True when the extracted JSON has the four top-level NotaFiscalSchema sections with the right types"""
+    return (isinstance(data, dict) and "error" not in data
+            and isinstance(data.get("estabelecimento"), dict)
+            and isinstance(data.get("nota_fiscal"), dict)
+            and isinstance(data.get("itens"), list)
+            and isinstance(data.get("totais"), dict))
+
+def _to_number(value):
+    """Parse numbers returned as JSON numbers or Brazilian-formatted strings ("1.125,09")"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = re.sub(r"[^\d,.\-]", "", str(value))
+    if "," in text:
+        text = text.replace(".", "").replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def _to_timestamp(value):
+    """Normalize ISO or dd/mm/yyyy [hh:mm[:ss]] dates to an ISO 8601 string"""
+    if not value:
+        return None
+    text = str(value).strip()
+    match = re.match(r"(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}:\d{2}(?::\d{2})?))?", text)
+    if match:
+        year, month, day, clock = match.groups()
+    else:
+        match = re.search(r"(\d{2})/(\d{2})/(\d{4}|\d{2})(?:\s+(\d{2}:\d{2}(?::\d{2})?))?", text)
+        if not match:
+            return None
+        day, month, year, clock = match.groups()
+        if len(year) == 2:
+            year = f"20{year}"
+    if clock and len(clock) == 5:
+        clock += ":00"
+    stamp = f"{year}-{month}-{day}T{clock or '00:00:00'}"
+    try:
+        datetime.datetime.fromisoformat(stamp)
+    except ValueError:
+        return None
+    return stamp
+
+def _digits(value):
+    digits = re.sub(r"\D", "", str(value)) if value else ""
+    return digits or None
+
+def _text(value):
+    if value is None:
+        return None
+    text = str(value).strip()
+    return text or None
+
+def parse_establishment(estab):
+    """Normalize the "estabelecimento" section into an establishments row (None without a CNPJ)"""
+    if not isinstance(estab, dict):
+        return None
+    cnpj = _digits(estab.get("cnpj"))
+    if not cnpj:
+        return None
+    endereco = estab.get("endereco") if isinstance(estab.get("endereco"), dict) else {}
+    return {
+        "cnpj": cnpj,
+        "nome": _text(estab.get("nome")),
+        "telefone": _text(estab.get("telefone")),
+        "inscricao_estadual": _text(estab.get("inscricao_estadual")),
+        "logradouro": _text(endereco.get("logradouro")),
+        "bairro": _text(endereco.get("bairro")),
+        "cidade": _text(endereco.get("cidade")),
+        "estado": _text(endereco.get("estado")),
+    }
+
+def parse_invoice(llm_response):
+    """
+    Validate the extracted NotaFiscalSchema JSON and normalize it into the rows
+    stored in establishments, invoices_parsed and invoice_items.
+    Returns None when the response has no usable invoice data.
+    """
+    data = extract_json_from_llm_response(llm_response)
+    if not isinstance(data, dict) or "error" in data:
+        return None
+    estab = data.get("estabelecimento") if isinstance(data.get("estabelecimento"), dict) else {}
+    nota = data.get("nota_fiscal") if isinstance(data.get("nota_fiscal"), dict) else {}
+    totais = data.get("totais") if isinstance(data.get("totais"), dict) else {}
+    itens = data.get("itens") if isinstance(data.get("itens"), list) else []
+    if not (estab or nota or totais or itens):
+        return None
+
+    cnpj = _digits(estab.get("cnpj"))
+    establishment = parse_establishment(estab)
+
+    invoice = {
+        "cnpj": cnpj,
+        "tipo": _text(nota.get("tipo")),
+        "numero": _text(nota.get("numero")),
+        "serie": _text(nota.get("serie")),
+        "data_emissao": _to_timestamp(nota.get("data_emissao")),
+        "chave_acesso": _digits(nota.get("chave_acesso")),
+        "protocolo_autorizacao": _text(nota.get("protocolo_autorizacao")),
+        "consumidor": _text(nota.get("consumidor")),
+        "valor_total": _to_number(totais.get("valor_total")),
+        "forma_pagamento": _text(totais.get("forma_pagamento")),
+        "valor_pago": _to_number(totais.get("valor_pago")),
+    }
+
+    items = []
+    for position, item in enumerate(itens, start=1):
+        if not isinstance(item, dict) or not _text(item.get("descricao")):
+            continue
+        items.append({
+            "item_index": position,
+            "codigo": _text(item.get("codigo")),
+            "descricao": _text(item.get("descricao")),
+            "quantidade": _to_number(item.get("quantidade")),
+            "valor_unitario": _to_number(item.get("valor_unitario")),
+            "valor_total": _to_number(item.get("valor_total")),
+        })
+
+    return {"establishment": establishment, "invoice": invoice, "items": items}
+
+class IncrementalJsonSections:
+    """
+    Parse the top-level sections ("estabelecimento", "nota_fiscal", ...) of a
+    JSON object while it is still being streamed. feed() returns the sections
+    completed by the new chunk; text before the opening brace (e.g. ```json)
+    is ignored.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.sections = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+
+    def feed(self, delta: str) -> dict:
+        self.buffer += delta
+        completed = {}
+        buf = self.buffer
+        while self._pos < len(buf):
+            ch = buf[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._key_start is not None:
+                        self._key = json.loads(buf[self._key_start:self._pos + 1])
+                        self._key_start = None
+            elif ch == '"':
+                self._in_string = True
+                if self._depth == 1 and self._value_start is None:
+                    self._key_start = self._pos
+            elif ch == ":" and self._depth == 1 and self._key is not None and self._value_start is None:
+                self._value_start = self._pos + 1
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in ",}]" and self._depth == 1 and self._value_start is not None:
+                try:
+                    completed[self._key] = json.loads(buf[self._value_start:self._pos])
+                except json.JSONDecodeError:
+                    pass
+                self._key = self._value_start = None
+                if ch != ",":
+                    self._depth -= 1
+            elif ch in "}]":
+                self._depth -= 1
+            self._pos += 1
+        self.sections.update(completed)
+        return completed
@@ -0,0 +1,96 @@
+"""
+Upload ingestion that keeps a single copy of the file bytes.
+
+ingest_upload() hashes the upload incrementally and exposes its bytes as a
+read-only buffer: the upload's own bytes for in-memory files (Streamlit's
+UploadedFile is a BytesIO), or a memory map of a temporary file for streams
+larger than INGEST_SPOOL_MAX_BYTES. The same buffer is handed to run_ocr and
+to storage.upload_invoice_file, which base64-encodes it on the fly.
+"""
+import io, os, mmap, hashlib, tempfile
+
+CHUNK_SIZE = 1024 * 1024
+
+class BufferReader(io.RawIOBase):
+    """Seekable file object over a bytes-like buffer (memoryview, mmap) that reads without copying the whole buffer"""
+
+    def __init__(self, buffer):
+        self._buffer = memoryview(buffer).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._buffer) - self._pos))
+        b[:n] = self._buffer[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._buffer)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+class IngestedFile:
+    """The bytes of an upload held once, with their size and SHA-256"""
+
+    def __init__(self, name: str, buffer: memoryview, sha256: str, resources: tuple = ()):
+        self.name = name
+        self.buffer = buffer
+        self.sha256 = sha256
+        self._resources = resources
+
+    @property
+    def size(self) -> int:
+        return len(self.buffer)
+
+    def close(self):
+        """Release the buffer (and the memory map/temporary file behind it, if any)"""
+        self.buffer.release()
+        for resource in self._resources:
+            resource.close()
+
+def _hash_buffer(buffer: memoryview) -> str:
+    digest = hashlib.sha256()
+    for start in range(0, len(buffer), CHUNK_SIZE):
+        digest.update(buffer[start:start + CHUNK_SIZE])
+    return digest.hexdigest()
+
+def ingest_upload(fileobj, name: str = None) -> IngestedFile:
+    """Read an upload once, hashing it as it streams, and return its bytes as a read-only buffer"""
+    name = name or getattr(fileobj, "name", "")
+    getvalue = getattr(fileobj, "getvalue", None)
+    if getvalue is not None:
+        # Already in memory. Streamlit's UploadedFile is a BytesIO created from the
+        # received bytes; CPython shares them copy-on-write, so getvalue() returns that
+        # same object (getbuffer() would force a private copy)
+        buffer = memoryview(getvalue())
+        return IngestedFile(name, buffer, _hash_buffer(buffer))
+
+    max_memory = int(os.getenv("INGEST_SPOOL_MAX_BYTES", str(8 * 1024 * 1024)))
+    digest = hashlib.sha256()
+    spool, spilled = io.BytesIO(), None
+    while True:
+        chunk = fileobj.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        if spilled is None and spool.tell() + len(chunk) > max_memory:
+            # Large stream: continue on disk and map it instead of growing a bytes object
+            spilled = tempfile.TemporaryFile()
+            spilled.write(spool.getbuffer())
+            spool = spilled
+        spool.write(chunk)
+
+    if spilled is None:
+        return IngestedFile(name, spool.getbuffer().toreadonly(), digest.hexdigest())
+    spilled.flush()
+    mapped = mmap.mmap(spilled.fileno(), 0, access=mmap.ACCESS_READ)
+    return IngestedFile(name, memoryview(mapped), digest.hexdigest(), (mapped, spilled))
@@ -1,24 +1,213 @@
-import os, requests, json
+import os, time, json, queue, random, socket, logging, threading, collections, requests, urllib3
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+from extraction import extract_json_from_llm_response, conforms_to_schema
+
+logger = logging.getLogger("app")
+
+# Rough chars-per-token ratio for Portuguese OCR text, used to fit prompts in the local context window
+CHARS_PER_TOKEN = 3
+
+# Cancel handle (_Abort) of the request running in the current LLMRouter thread, if any
+_in_flight = threading.local()
+
+class _Abort:
+    """Connection of one in-flight request, which another thread can shut down to cancel it"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+        self.aborted = False
+
+    def attach(self, conn):
+        with self._lock:
+            self._conn = conn
+            if self.aborted:
+                self._shutdown()
+
+    def detach(self):
+        with self._lock:
+            self._conn = None
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            self._shutdown()
+
+    def _shutdown(self):
+        # shutdown() (unlike close()) wakes a thread blocked reading the socket, even
+        # before the response headers arrive
+        sock = getattr(self._conn, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class _AbortableConnection:
+    def connect(self):
+        super().connect()
+        self._attach()
+
+    def request(self, *args, **kwargs):
+        self._attach()
+        return super().request(*args, **kwargs)
+
+    def _attach(self):
+        abort = getattr(_in_flight, "abort", None)
+        if abort is not None:
+            abort.attach(self)
+
+class _HTTPConnection(_AbortableConnection, urllib3.connection.HTTPConnection):
+    pass
+
+class _HTTPSConnection(_AbortableConnection, urllib3.connection.HTTPSConnection):
+    pass
+
+class _HTTPPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+class _HTTPSPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+class _AbortableAdapter(requests.adapters.HTTPAdapter):
+    """Registers each connection with the calling thread's _Abort, so LLMRouter can cancel it"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPPool, "https": _HTTPSPool}
+
+@lru_cache(maxsize=None)
+def _session() -> requests.Session:
+    """HTTP session shared by all clients in the process (keeps connections alive)"""
+    session = requests.Session()
+    session.mount("http://", _AbortableAdapter())
+    session.mount("https://", _AbortableAdapter())
+    return session
+
+@lru_cache(maxsize=None)
+def get_llm_client(provider: str = None, model: str = None):
+    """
+    Return the LLM client for this process, built once and reused across
+    Streamlit reruns: an LLMRouter when LLM_PROVIDERS lists two or more
+    providers (and no provider is forced), otherwise a single LLMClient.
+    """
+    providers = [p.strip().lower() for p in os.getenv("LLM_PROVIDERS", "").split(",") if p.strip()]
+    if provider is None and model is None and len(providers) > 1:
+        return LLMRouter([LLMClient(p) for p in providers])
+    return LLMClient(provider, model)
+
+def _send_batch(send, prompts: list, batch_size: int) -> list:
+    def _send(prompt):
+        try:
+            return send(prompt)
+        except Exception as e:
+            return e
+    if len(prompts) <= 1:
+        return [_send(p) for p in prompts]
+    with ThreadPoolExecutor(max_workers=min(batch_size, len(prompts)), thread_name_prefix="llm-batch") as pool:
+        return list(pool.map(_send, prompts))
 
 class LLMClient:
     def __init__(self, provider: str = None, model: str = None):
         self.provider = (provider or os.getenv("LLM_PROVIDER", "openai")).lower()
-        self.model = model or os.getenv("LLM_MODEL", "")
+        # LLM_MODEL_<PROVIDER> (e.g. LLM_MODEL_ANTHROPIC) wins over LLM_MODEL, for multi-provider routing
+        self.model = model or os.getenv(f"LLM_MODEL_{self.provider.upper()}") or os.getenv("LLM_MODEL", "")
         self.openai_key = os.getenv("OPENAI_API_KEY", "")
         self.anthropic_key = os.getenv("ANTHROPIC_API_KEY", "")
+        # Base URLs can point to a compatible local server (e.g. the benchmark mock)
+        self.openai_base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+        self.anthropic_base_url = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com/v1").rstrip("/")
+        # Local OpenAI-compatible server (llama.cpp `llama-server`, Ollama, ...) running on CPU
+        self.local_base_url = os.getenv("LOCAL_LLM_BASE_URL", "http://localhost:8080/v1").rstrip("/")
+        self.local_key = os.getenv("LOCAL_LLM_API_KEY", "")
+        self.local_context = int(os.getenv("LOCAL_LLM_CONTEXT", "4096"))
+        self.local_max_tokens = int(os.getenv("LOCAL_LLM_MAX_TOKENS", "1024"))
+        self.local_timeout = float(os.getenv("LOCAL_LLM_TIMEOUT", "300"))
+        # Concurrent requests in send_batch(); match the server slots (llama-server --parallel, OLLAMA_NUM_PARALLEL)
+        self.batch_size = int(os.getenv("LLM_BATCH_SIZE", "4"))
+
+    def send(self, prompt: str, on_delta=None) -> dict:
+        """
+        Send the prompt and return {"provider", "model", "content", "raw"}.
+        With on_delta(delta, content_so_far) the response is streamed (SSE) and
+        the callback runs for every text chunk as it arrives; an exception
+        raised by the callback closes the connection and stops the generation.
+        """
+        if on_delta is None:
+            if self.provider == "openai":
+                return self._send_openai(prompt)
+            elif self.provider == "anthropic":
+                return self._send_anthropic(prompt)
+            elif self.provider == "local":
+                return self._send_local(prompt)
+            else:
+                raise RuntimeError(f"LLM provider não suportado: {self.provider}")
+
+        content = ""
+        for delta in self.stream(prompt):
+            content += delta
+            on_delta(delta, content)
+        model = self._request(prompt)[2]["model"]
+        # Same shape as the non-streamed responses, so extraction works unchanged
+        if self.provider in ("openai", "local"):
+            raw = {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}], "model": model, "stream": True}
+        else:
+            raw = {"content": [{"type": "text", "text": content}], "model": model, "stream": True}
+        return {"provider": self.provider, "model": model, "content": content, "raw": raw}
+
+    def stream(self, prompt: str):
+        """Yield the response text chunk by chunk (server-sent events); closing the generator aborts the request"""
+        url, headers, data = self._request(prompt)
+        provider = {"openai": "OpenAI", "anthropic": "Anthropic", "local": "LLM local"}[self.provider]
+        data["stream"] = True
+        # (connect, read) timeout: the read timeout applies between chunks, not to the whole generation
+        read_timeout = self.local_timeout if self.provider == "local" else 60
+        with _session().post(url, headers=headers, data=json.dumps(data), stream=True, timeout=(10, read_timeout)) as r:
+            if not r.ok:
+                raise RuntimeError(f"Erro da {provider}: {r.status_code} {r.text}")
+            for line in r.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[len(b"data:"):].strip()
+                if payload == b"[DONE]":
+                    break
+                event = json.loads(payload)
+                if self.provider in ("openai", "local"):
+                    choices = event.get("choices") or [{}]
+                    delta = (choices[0].get("delta") or {}).get("content")
+                else:
+                    if event.get("type") == "error":
+                        raise RuntimeError(f"Erro da Anthropic: {event.get('error')}")
+                    if event.get("type") == "message_stop":
+                        break
+                    delta = (event.get("delta") or {}).get("text") if event.get("type") == "content_block_delta" else None
+                if delta:
+                    yield delta
 
-    def send(self, prompt: str) -> dict:
+    def _request(self, prompt: str):
+        """(url, headers, body) of the provider's completion request"""
         if self.provider == "openai":
-            return self._send_openai(prompt)
+            return self._openai_request(prompt)
         elif self.provider == "anthropic":
-            return self._send_anthropic(prompt)
-        else:
-            raise RuntimeError(f"LLM provider não suportado: {self.provider}")
+            return self._anthropic_request(prompt)
+        elif self.provider == "local":
+            return self._local_request(prompt)
+        raise RuntimeError(f"LLM provider não suportado: {self.provider}")
 
-    def _send_openai(self, prompt: str) -> dict:
+    def send_batch(self, prompts: list) -> list:
+        """
+        Send several prompts concurrently (up to LLM_BATCH_SIZE in flight), so a
+        local server with parallel slots batches them on the CPU. Returns one
+        entry per prompt, in order: the response dict or the exception raised.
+        """
+        return _send_batch(self.send, prompts, self.batch_size)
+
+    def _openai_request(self, prompt: str):
         if not self.openai_key:
             raise RuntimeError("OPENAI_API_KEY não configurada")
-        url = "https://api.openai.com/v1/chat/completions"
+        url = f"{self.openai_base_url}/chat/completions"
         headers = {
             "Authorization": f"Bearer {self.openai_key}",
             "Content-Type": "application/json"
@@ -30,17 +219,21 @@ class LLMClient:
                 {"role": "user", "content": prompt}
             ]
         }
-        r = requests.post(url, headers=headers, data=json.dumps(data), timeout=60)
+        return url, headers, data
+
+    def _send_openai(self, prompt: str) -> dict:
+        url, headers, data = self._openai_request(prompt)
+        r = _session().post(url, headers=headers, data=json.dumps(data), timeout=60)
         if not r.ok:
             raise RuntimeError(f"Erro da OpenAI: {r.status_code} {r.text}")
         out = r.json()
         content = out["choices"][0]["message"]["content"]
         return {"provider": "openai", "model": data["model"], "content": content, "raw": out}
 
-    def _send_anthropic(self, prompt: str) -> dict:
+    def _anthropic_request(self, prompt: str):
         if not self.anthropic_key:
             raise RuntimeError("ANTHROPIC_API_KEY não configurada")
-        url = "https://api.anthropic.com/v1/messages"
+        url = f"{self.anthropic_base_url}/messages"
         headers = {
             "x-api-key": self.anthropic_key,
             "anthropic-version": "2023-06-01",
@@ -54,7 +247,11 @@ class LLMClient:
             ],
             "system": "Você é um assistente que extrai e valida dados de notas fiscais."
         }
-        r = requests.post(url, headers=headers, data=json.dumps(data), timeout=60)
+        return url, headers, data
+
+    def _send_anthropic(self, prompt: str) -> dict:
+        url, headers, data = self._anthropic_request(prompt)
+        r = _session().post(url, headers=headers, data=json.dumps(data), timeout=60)
         if not r.ok:
             raise RuntimeError(f"Erro da Anthropic: {r.status_code} {r.text}")
         out = r.json()
@@ -63,3 +260,262 @@ class LLMClient:
             if blk.get("type") == "text":
                 content += blk.get("text", "")
         return {"provider": "anthropic", "model": data["model"], "content": content, "raw": out}
+
+    def _fit_local_context(self, prompt: str) -> str:
+        """
+        Cut the middle of the OCR text when the prompt would not fit in LOCAL_LLM_CONTEXT.
+        The OpenAI-compatible endpoints can't set the context size per request, so the
+        window is whatever the server was started with (llama-server -c / --parallel,
+        Ollama num_ctx); LOCAL_LLM_CONTEXT must match it.
+        """
+        budget = (self.local_context - self.local_max_tokens - 100) * CHARS_PER_TOKEN
+        if len(prompt) <= budget:
+            return prompt
+        marker = prompt.find("Texto OCR:\n")
+        head_end = marker + len("Texto OCR:\n") if marker >= 0 else 0
+        # Header (emitente, CNPJ) and footer (totais, chave de acesso) matter most on receipts
+        keep = max(0, budget - head_end)
+        return prompt[:head_end + keep // 2] + "\n[...]\n" + prompt[len(prompt) - keep // 2:]
+
+    def _local_request(self, prompt: str):
+        url = f"{self.local_base_url}/chat/completions"
+        headers = {"Content-Type": "application/json"}
+        if self.local_key:
+            headers["Authorization"] = f"Bearer {self.local_key}"
+        data = {
+            "model": self.model or "qwen2.5:3b-instruct",
+            "messages": [
+                {"role": "system", "content": "Você é um assistente que extrai e valida dados de notas fiscais brasileiras. Responda apenas com o JSON no schema pedido."},
+                {"role": "user", "content": self._fit_local_context(prompt)}
+            ],
+            "max_tokens": self.local_max_tokens,
+            "temperature": 0,
+            # Constrained JSON output (llama.cpp grammar / Ollama format); small models drift without it
+            "response_format": {"type": "json_object"},
+        }
+        return url, headers, data
+
+    def _send_local(self, prompt: str) -> dict:
+        url, headers, data = self._local_request(prompt)
+        try:
+            r = _session().post(url, headers=headers, data=json.dumps(data), timeout=self.local_timeout)
+        except requests.exceptions.ConnectionError as e:
+            raise RuntimeError(f"LLM local indisponível em {self.local_base_url}: {e}")
+        if not r.ok:
+            raise RuntimeError(f"Erro da LLM local: {r.status_code} {r.text}")
+        out = r.json()
+        content = out["choices"][0]["message"]["content"]
+        return {"provider": "local", "model": data["model"], "content": content, "raw": out}
+
+class _Cancelled(Exception):
+    """Raised inside a losing hedged request to close its stream"""
+
+class _ProviderHealth:
+    """Latency samples and error rate of one provider, used to weight routing"""
+
+    def __init__(self, window: int = 100):
+        self.latencies = collections.deque(maxlen=window)
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+
+    def percentile(self, q: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def weight(self, now: float) -> float:
+        if now < self.down_until:
+            return 0.0
+        p50 = self.percentile(0.5) or 1.0
+        return max(0.01, 1.0 - self.error_rate) / p50
+
+class LLMRouter:
+    """
+    Route each request to one of several LLMClients and hedge slow ones.
+
+    The primary provider is drawn with weights from its recent p50 latency and
+    error rate. If it has not answered by its LLM_HEDGE_PERCENTILE latency, the
+    same prompt goes to the next best provider; the first answer that conforms
+    to NotaFiscalSchema wins and the other request is cancelled (its
+    connection is shut down right away). Each call is also cut after
+    LLM_HEDGE_TIMEOUT seconds. Failures, invalid answers and timeouts trigger
+    the hedge immediately; three failures in a row take a provider out for a
+    while. Only completed answers count as latency samples.
+    """
+
+    def __init__(self, clients: list):
+        self.clients = clients
+        self.health = {c.provider: _ProviderHealth() for c in clients}
+        self.hedge_percentile = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9"))
+        # Deadline used until a provider has LLM_HEDGE_MIN_SAMPLES latency samples
+        self.default_deadline = float(os.getenv("LLM_HEDGE_DEADLINE", "10"))
+        self.min_samples = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "10"))
+        # Total time limit of each provider call, so a stalled provider can't hold a pool thread
+        self.call_timeout = float(os.getenv("LLM_HEDGE_TIMEOUT", "120"))
+        self.batch_size = int(os.getenv("LLM_BATCH_SIZE", "4"))
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(8, 2 * self.batch_size * len(clients)),
+                                        thread_name_prefix="llm-hedge")
+
+    @property
+    def provider(self) -> str:
+        return "router:" + ",".join(c.provider for c in self.clients)
+
+    def stats(self) -> dict:
+        """Current health of each provider (p50/p95 latency in s, error rate, availability)"""
+        now = time.monotonic()
+        with self._lock:
+            return {p: {"p50_s": h.percentile(0.5), "p95_s": h.percentile(0.95), "samples": len(h.latencies),
+                        "error_rate": round(h.error_rate, 3), "available": now >= h.down_until}
+                    for p, h in self.health.items()}
+
+    def _order(self) -> list:
+        """Clients in routing order: a weighted draw for the primary, then the rest by weight"""
+        now = time.monotonic()
+        with self._lock:
+            weights = {c.provider: self.health[c.provider].weight(now) for c in self.clients}
+        candidates = [c for c in self.clients if weights[c.provider] > 0] or list(self.clients)
+        primary = random.choices(candidates, weights=[weights[c.provider] or 1.0 for c in candidates])[0]
+        rest = sorted((c for c in self.clients if c is not primary), key=lambda c: weights[c.provider], reverse=True)
+        return [primary] + rest
+
+    def _deadline(self, client) -> float:
+        with self._lock:
+            health = self.health[client.provider]
+            if len(health.latencies) < self.min_samples:
+                return self.default_deadline
+            return max(0.5, health.percentile(self.hedge_percentile))
+
+    def _record(self, provider: str, latency: float = None, ok: bool = None):
+        with self._lock:
+            health = self.health[provider]
+            if latency is not None:
+                health.latencies.append(latency)
+            if ok is None:
+                return
+            health.error_rate = 0.8 * health.error_rate + 0.2 * (0.0 if ok else 1.0)
+            health.consecutive_failures = 0 if ok else health.consecutive_failures + 1
+            if health.consecutive_failures >= 3:
+                health.down_until = time.monotonic() + 30
+
+    def send(self, prompt: str, on_delta=None) -> dict:
+        """
+        Same contract as LLMClient.send. on_delta is called from the calling
+        thread (safe for Streamlit) with the chunks of one provider, the leader:
+        the first that starts answering. When the leader fails, or another
+        provider's answer is the one returned, the view switches to that
+        provider and on_delta receives its whole text so far as the delta
+        (delta == content); callers that parse the stream start over then.
+        """
+        order = self._order()
+        events = queue.Queue()
+        cancel = threading.Event()
+        # running: provider -> {"start", "hedge_at", "abort"} of the calls still in flight
+        launched, running, streamed = [], {}, {}
+
+        def call(client, abort):
+            def relay(delta, content):
+                if cancel.is_set():
+                    raise _Cancelled()
+                events.put(("delta", client, (delta, content)))
+            _in_flight.abort = abort
+            try:
+                resp = client.send(prompt, on_delta=relay)
+                events.put(("done", client, resp))
+            except Exception as e:
+                # Once aborted, the shut-down connection surfaces as an error; it was already accounted for
+                if not isinstance(e, _Cancelled) and not abort.aborted:
+                    events.put(("error", client, e))
+            finally:
+                _in_flight.abort = None
+                abort.detach()
+
+        def launch():
+            client = order[len(launched)]
+            launched.append(client)
+            now = time.perf_counter()
+            running[client.provider] = {"start": now, "hedge_at": now + self._deadline(client), "abort": _Abort()}
+            self._pool.submit(call, client, running[client.provider]["abort"])
+            return running[client.provider]["hedge_at"]
+
+        def follow(client, content: str):
+            nonlocal leader
+            leader = client
+            if on_delta and client is not None and content:
+                on_delta(content, content)
+
+        hedge_at = launch()
+        leader, fallback, errors = None, None, []
+        try:
+            while True:
+                wake = [c["start"] + self.call_timeout for c in running.values()]
+                if len(launched) < len(order):
+                    wake.append(hedge_at)
+                try:
+                    pending = [events.get(timeout=max(0.0, min(wake) - time.perf_counter()))]
+                except queue.Empty:
+                    now = time.perf_counter()
+                    pending = [("error", c, RuntimeError(f"sem resposta completa em {self.call_timeout:.0f}s"))
+                               for c in launched
+                               if c.provider in running and now >= running[c.provider]["start"] + self.call_timeout]
+                    if not pending:
+                        logger.info(f"LLM hedge: {launched[-1].provider} sem resposta; enviando também para {order[len(launched)].provider}")
+                        hedge_at = launch()
+                        continue
+                    for _, c, _ in pending:
+                        running[c.provider]["abort"].abort()
+
+                for kind, client, payload in pending:
+                    if client.provider not in running:
+                        # Late event of a call that already timed out
+                        continue
+                    if kind == "delta":
+                        streamed[client.provider] = payload[1]
+                        if leader is None:
+                            follow(client, payload[1])
+                        elif on_delta and client is leader:
+                            on_delta(*payload)
+                        continue
+
+                    elapsed = time.perf_counter() - running.pop(client.provider)["start"]
+                    if kind == "done" and conforms_to_schema(extract_json_from_llm_response(payload)):
+                        self._record(client.provider, elapsed, ok=True)
+                        if client is not leader:
+                            follow(client, payload.get("content") or "")
+                        return payload
+                    if kind == "done":
+                        fallback = (client, payload)
+                        errors.append(f"{client.provider}: resposta fora do schema")
+                    else:
+                        errors.append(f"{client.provider}: {payload}")
+                    self._record(client.provider, ok=False)
+                    if client is leader:
+                        # Keep streaming from a provider that is still answering
+                        successor = next((c for c in launched if c.provider in running and streamed.get(c.provider)), None)
+                        follow(successor, streamed.get(successor.provider) if successor else "")
+                    if len(launched) < len(order):
+                        # Failed or invalid: hedge right away instead of waiting for the deadline
+                        hedge_at = launch()
+                    elif not running:
+                        if fallback is not None:
+                            # No valid answer anywhere; keep the previous behaviour of saving what came back
+                            client, payload = fallback
+                            if client is not leader:
+                                follow(client, payload.get("content") or "")
+                            return payload
+                        raise RuntimeError("Todos os provedores LLM falharam: " + "; ".join(errors))
+        finally:
+            cancel.set()
+            now = time.perf_counter()
+            for provider, running_call in running.items():
+                running_call["abort"].abort()
+                # Partial times of cancelled calls are not latency samples. A call that was
+                # hedged for being slow and never produced output counts as a timeout
+                if provider not in streamed and now >= running_call["hedge_at"]:
+                    self._record(provider, ok=False)
+
+    def send_batch(self, prompts: list) -> list:
+        """Same contract as LLMClient.send_batch"""
+        return _send_batch(self.send, prompts, self.batch_size)
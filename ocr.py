@@ -1,13 +1,38 @@
-import io, os
+import os, re, math, tempfile, statistics
+from functools import lru_cache
 from PIL import Image, ImageEnhance, ImageFilter
-import pytesseract
-from pdf2image import convert_from_bytes
 
-# Configure Tesseract command path (for local development)
-# Streamlit Cloud will use the system tesseract from packages.txt
-TESSERACT_CMD = os.getenv("TESSERACT_CMD", "").strip()
-if TESSERACT_CMD:
-    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+from ingest import BufferReader
+
+# pytesseract (which pulls in pandas when installed) and pdf2image are imported
+# on first use, so pages that never run OCR don't pay for them at startup
+
+@lru_cache(maxsize=None)
+def _tesseract():
+    import pytesseract
+    # Configure Tesseract command path (for local development)
+    # Streamlit Cloud will use the system tesseract from packages.txt
+    tesseract_cmd = os.getenv("TESSERACT_CMD", "").strip()
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    return pytesseract
+
+@lru_cache(maxsize=None)
+def _pdf_settings() -> dict:
+    """
+    PDF rasterization settings (all optional). Pages are rendered in grayscale
+    at a low probe DPI and only re-rendered at a higher DPI, sized from the
+    detected text height, when the probe OCR confidence is low.
+    """
+    return {
+        "adaptive": os.getenv("OCR_PDF_ADAPTIVE", "1") != "0",
+        "probe_dpi": int(os.getenv("OCR_PDF_PROBE_DPI", "150")),
+        "max_dpi": int(os.getenv("OCR_PDF_MAX_DPI", "300")),
+        "max_pixels": int(os.getenv("OCR_PDF_MAX_PIXELS", "25000000")),
+        "min_confidence": float(os.getenv("OCR_MIN_CONFIDENCE", "70")),
+        # Tesseract reads best with word boxes around 30 px tall
+        "target_text_px": 30,
+    }
 
 SUPPORTED_IMG_EXT = {".png", ".jpg", ".jpeg", ".tiff", ".bmp", ".webp"}
 SUPPORTED_DOC_EXT = {".pdf"} | SUPPORTED_IMG_EXT
@@ -17,8 +42,8 @@ def _preprocess_image_for_tesseract(img: Image.Image) -> Image.Image:
     Light preprocessing for Tesseract OCR
     Tesseract works best with minimal preprocessing on good quality images
     """
-    # Convert to RGB if not already
-    if img.mode != 'RGB':
+    # Convert to RGB if not already (grayscale PDF renders stay single-channel)
+    if img.mode not in ('RGB', 'L'):
         img = img.convert('RGB')
     
     # Very light sharpening to help with slightly blurry receipts
@@ -47,6 +72,7 @@ def _ocr_pil_image(img: Image.Image) -> str:
     # Try Portuguese first, then Portuguese+English combined
     custom_config = r'--oem 3 --psm 6 -l por'
     
+    pytesseract = _tesseract()
     try:
         text = pytesseract.image_to_string(img, config=custom_config)
         
@@ -60,17 +86,257 @@ def _ocr_pil_image(img: Image.Image) -> str:
         # Fallback to default configuration
         return pytesseract.image_to_string(img)
 
-def _open_image_from_bytes(b: bytes) -> Image.Image:
-    return Image.open(io.BytesIO(b)).convert("RGB")
+def _open_image_from_bytes(b) -> Image.Image:
+    # bytes, memoryview or mmap (see ingest.py); BufferReader avoids BytesIO copying the whole file
+    return Image.open(BufferReader(b)).convert("RGB")
 
-def run_ocr(file_bytes: bytes, filename: str) -> str:
+# Lines that matter most for extraction get a stricter confidence bar before re-OCR
+_KEY_LINE_RE = re.compile(r"total|cnpj|valor|pagar|chave|\d{2}\.?\d{3}\.?\d{3}/", re.IGNORECASE)
+
+class OcrResult:
+    """
+    OCR output with per-word confidence (0-100) and bounding boxes in pixels
+    of the image that was read. words are dicts with text, conf, left, top,
+    width, height, page and line (block, paragraph, line numbers).
+    """
+
+    def __init__(self, text: str, words: list = None, reocr_regions: int = 0, reocr_improved: int = 0):
+        self.text = text
+        self.words = words or []
+        self.reocr_regions = reocr_regions
+        self.reocr_improved = reocr_improved
+
+    @property
+    def mean_confidence(self) -> float:
+        return statistics.fmean(w["conf"] for w in self.words) if self.words else 0.0
+
+    @property
+    def median_text_height(self) -> float:
+        return statistics.median(w["height"] for w in self.words) if self.words else 0.0
+
+    def lines(self) -> list:
+        """[(text, mean confidence, words)] in reading order"""
+        grouped = {}
+        for w in self.words:
+            grouped.setdefault((w["page"], w["line"]), []).append(w)
+        return [(" ".join(w["text"] for w in ws), statistics.fmean(w["conf"] for w in ws), ws)
+                for ws in grouped.values()]
+
+    def summary(self) -> dict:
+        """Confidence summary stored with the invoice (invoices.ocr_confidence)"""
+        cfg = _reocr_settings()
+        lines = self.lines()
+        low = sorted((l for l in lines if l[1] < cfg["min_line_confidence"]), key=lambda l: l[1])
+        return {
+            "mean": round(self.mean_confidence, 1),
+            "min_line": round(min((l[1] for l in lines), default=0.0), 1),
+            "words": len(self.words),
+            "low_confidence_words": sum(1 for w in self.words if w["conf"] < cfg["min_line_confidence"]),
+            "low_confidence_lines": [{"text": t[:80], "conf": round(c, 1)} for t, c, _ in low[:5]],
+            "reocr_regions": self.reocr_regions,
+            "reocr_improved": self.reocr_improved,
+        }
+
+    @classmethod
+    def merge(cls, results: list) -> "OcrResult":
+        """Combine the results of the pages of a document"""
+        words = []
+        for page, result in enumerate(results, start=1):
+            words += [{**w, "page": page} for w in result.words]
+        return cls("\n\n".join(r.text for r in results).strip(), words,
+                   sum(r.reocr_regions for r in results), sum(r.reocr_improved for r in results))
+
+@lru_cache(maxsize=None)
+def _reocr_settings() -> dict:
+    """Selective re-OCR of low-confidence lines (all optional)"""
+    return {
+        "min_line_confidence": float(os.getenv("OCR_LINE_MIN_CONFIDENCE", "60")),
+        # Totals, CNPJ and access key lines are re-read below this confidence
+        "min_key_line_confidence": float(os.getenv("OCR_KEY_LINE_MIN_CONFIDENCE", "80")),
+        "max_regions": int(os.getenv("OCR_MAX_REOCR_REGIONS", "12")),
+        # Re-read crops are upscaled so the line is about this tall, up to 4x
+        "target_line_px": 48,
+    }
+
+def _data_to_words(data: dict, offset=(0, 0), scale: float = 1.0) -> list:
+    """Words from image_to_data output, with boxes mapped back through offset/scale"""
+    words = []
+    for n, word in enumerate(data["text"]):
+        conf = float(data["conf"][n])
+        if not word.strip() or conf < 0:
+            continue
+        words.append({
+            "text": word,
+            "conf": conf,
+            "left": offset[0] + round(data["left"][n] / scale),
+            "top": offset[1] + round(data["top"][n] / scale),
+            "width": round(data["width"][n] / scale),
+            "height": round(data["height"][n] / scale),
+            "page": 1,
+            "line": (data["block_num"][n], data["par_num"][n], data["line_num"][n]),
+        })
+    return words
+
+def _words_to_text(words: list) -> str:
+    """Page text with one line per Tesseract line and a blank line between blocks"""
+    out, line_key, block_key = [], None, None
+    for w in words:
+        if w["line"] != line_key:
+            if out:
+                out.append("\n\n" if w["line"][:2] != block_key else "\n")
+            line_key, block_key = w["line"], w["line"][:2]
+        elif out:
+            out.append(" ")
+        out.append(w["text"])
+    return "".join(out)
+
+def _image_to_data(img: Image.Image, config: str) -> dict:
+    pytesseract = _tesseract()
+    return pytesseract.image_to_data(img, config=config, output_type=pytesseract.Output.DICT)
+
+def _reocr_line(img: Image.Image, words: list, cfg: dict):
+    """Re-read one line from a padded, upscaled crop as a single text line (--psm 7)"""
+    left = min(w["left"] for w in words)
+    top = min(w["top"] for w in words)
+    right = max(w["left"] + w["width"] for w in words)
+    bottom = max(w["top"] + w["height"] for w in words)
+    pad = max(4, (bottom - top) // 3)
+    box = (max(0, left - pad), max(0, top - pad), min(img.width, right + pad), min(img.height, bottom + pad))
+    scale = min(4.0, max(2.0, cfg["target_line_px"] / max(1, bottom - top)))
+    crop = img.crop(box)
+    crop = crop.resize((round(crop.width * scale), round(crop.height * scale)), Image.LANCZOS)
+    new_words = _data_to_words(_image_to_data(crop, r'--oem 3 --psm 7 -l por'), offset=box[:2], scale=scale)
+    for w in new_words:
+        w["line"] = words[0]["line"]
+    return new_words
+
+def _ocr_words(img: Image.Image) -> OcrResult:
+    """
+    Whole-image OCR with word confidences (image_to_data, same language
+    fallback as _ocr_pil_image) of an already preprocessed image
+    """
+    try:
+        words = _data_to_words(_image_to_data(img, r'--oem 3 --psm 6 -l por'))
+        if len(_words_to_text(words).strip()) < 50:
+            words = _data_to_words(_image_to_data(img, r'--oem 3 --psm 6 -l por+eng'))
+    except Exception:
+        # Fallback to default configuration, without confidences
+        return OcrResult(_tesseract().image_to_string(img))
+    return OcrResult(_words_to_text(words), words)
+
+def _reocr_lines(img: Image.Image, result: OcrResult) -> OcrResult:
+    """
+    Re-read only the low-confidence lines of result -- key lines such as
+    totals and the CNPJ first -- from upscaled crops of img, keeping the new
+    reading when its confidence is higher.
+    """
+    cfg = _reocr_settings()
+    words = result.words
+    candidates = []
+    for text, conf, line_words in result.lines():
+        is_key = bool(_KEY_LINE_RE.search(text))
+        if conf < (cfg["min_key_line_confidence"] if is_key else cfg["min_line_confidence"]):
+            candidates.append((not is_key, conf, line_words))
+    candidates.sort(key=lambda c: c[:2])
+
+    replaced = {}
+    for _, conf, line_words in candidates[:cfg["max_regions"]]:
+        result.reocr_regions += 1
+        try:
+            new_words = _reocr_line(img, line_words, cfg)
+        except Exception:
+            continue
+        if new_words and statistics.fmean(w["conf"] for w in new_words) > conf:
+            replaced[line_words[0]["line"]] = new_words
+            result.reocr_improved += 1
+    if replaced:
+        merged, done = [], set()
+        for w in words:
+            if w["line"] not in replaced:
+                merged.append(w)
+            elif w["line"] not in done:
+                merged += replaced[w["line"]]
+                done.add(w["line"])
+        result.words = merged
+        result.text = _words_to_text(merged)
+    return result
+
+def _ocr_image_result(img: Image.Image) -> OcrResult:
+    """OCR with word confidences, then selective re-OCR of low-confidence lines"""
+    img = _preprocess_image_for_tesseract(img)
+    return _reocr_lines(img, _ocr_words(img))
+
+def _render_pdf_page(pdf_path: str, page: int, dpi: int) -> Image.Image:
+    from pdf2image import convert_from_path
+    return convert_from_path(pdf_path, dpi=dpi, first_page=page, last_page=page, grayscale=True)[0]
+
+def _max_dpi_for_area(area_sq_in: float, cfg: dict) -> int:
+    """Highest DPI that keeps a page of the given area under the pixel budget"""
+    if area_sq_in <= 0:
+        return cfg["max_dpi"]
+    return min(cfg["max_dpi"], int(math.sqrt(cfg["max_pixels"] / area_sq_in)))
+
+def _ocr_pdf_page(pdf_path: str, page: int, probe_path: str, probe_dpi: int, cfg: dict) -> OcrResult:
+    # Escalation is decided on the whole-page reading alone; line re-OCR then runs
+    # only on the resolution that is kept
+    with Image.open(probe_path) as probe:
+        img = _preprocess_image_for_tesseract(probe)
+    result = _ocr_words(img)
+    if result.mean_confidence < cfg["min_confidence"]:
+        # Low confidence: scale the DPI so the median word reaches the target height
+        # (straight to the ceiling when no words were found), within the pixel budget
+        ceiling = _max_dpi_for_area((img.width / probe_dpi) * (img.height / probe_dpi), cfg)
+        if result.median_text_height > 0:
+            dpi = min(ceiling, int(probe_dpi * cfg["target_text_px"] / result.median_text_height))
+        else:
+            dpi = ceiling
+        if dpi > probe_dpi:
+            hi_img = _preprocess_image_for_tesseract(_render_pdf_page(pdf_path, page, dpi))
+            hi_result = _ocr_words(hi_img)
+            if hi_result.mean_confidence >= result.mean_confidence:
+                img, result = hi_img, hi_result
+    return _reocr_lines(img, result)
+
+def _ocr_pdf(file_bytes: bytes) -> OcrResult:
+    from pdf2image import convert_from_path, pdfinfo_from_path
+    cfg = _pdf_settings()
+    # pdf2image's *_from_bytes helpers copy the whole PDF to a new temp file (and start
+    # poppler) on every call, so the document is written once and every call uses the path
+    with tempfile.TemporaryDirectory(prefix="ocr-pdf-") as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "document.pdf")
+        with open(pdf_path, "wb") as fh:
+            fh.write(file_bytes)
+
+        if not cfg["adaptive"]:
+            # Previous behaviour: every page at the maximum DPI, in color, without confidences
+            pages = convert_from_path(pdf_path, dpi=cfg["max_dpi"])
+            return OcrResult("\n\n".join(_ocr_pil_image(page) for page in pages).strip())
+
+        info = pdfinfo_from_path(pdf_path)
+        # Keep the probe of very long pages (e.g. thermal receipts) under the pixel budget
+        probe_dpi = cfg["probe_dpi"]
+        size = re.match(r"([\d.]+) x ([\d.]+) pts", info.get("Page size", ""))
+        if size:
+            probe_dpi = min(probe_dpi, _max_dpi_for_area(float(size[1]) * float(size[2]) / 72 ** 2, cfg))
+        # All probes come from a single pdftoppm run written to disk; pages are then
+        # opened one at a time, so only a single bitmap is alive at any moment
+        probe_paths = convert_from_path(pdf_path, dpi=probe_dpi, grayscale=True,
+                                        output_folder=tmp_dir, paths_only=True)
+        return OcrResult.merge([_ocr_pdf_page(pdf_path, page, probe_path, probe_dpi, cfg)
+                                for page, probe_path in enumerate(probe_paths, 1)])
+
+def run_ocr_result(file_bytes: bytes, filename: str) -> OcrResult:
+    """
+    OCR a document keeping word confidences and boxes (see OcrResult.summary()).
+    file_bytes may be any bytes-like buffer, e.g. IngestedFile.buffer.
+    """
     name = filename.lower()
     if name.endswith(".pdf"):
-        pages = convert_from_bytes(file_bytes, dpi=300)
-        texts = []
-        for page in pages:
-            texts.append(_ocr_pil_image(page))
-        return "\n\n".join(texts).strip()
-    else:
-        img = _open_image_from_bytes(file_bytes)
-        return _ocr_pil_image(img).strip()
+        return _ocr_pdf(file_bytes)
+    img = _open_image_from_bytes(file_bytes)
+    result = _ocr_image_result(img)
+    result.text = result.text.strip()
+    return result
+
+def run_ocr(file_bytes: bytes, filename: str) -> str:
+    return run_ocr_result(file_bytes, filename).text
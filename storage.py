@@ -0,0 +1,256 @@
+import os, json, base64, datetime
+from functools import lru_cache
+import requests
+
+@lru_cache(maxsize=None)
+def _config() -> dict:
+    """Supabase configuration, read once per process"""
+    supabase_url = os.getenv("SUPABASE_URL", "").rstrip("/")
+    api_key = os.getenv("SUPABASE_API_KEY", "")
+    table = os.getenv("SUPABASE_TABLE", "invoices")
+    return {
+        "url": supabase_url,
+        "api_key": api_key,
+        "table": table,
+        "rest_base": f"{supabase_url}/rest/v1",
+        "rest_url": f"{supabase_url}/rest/v1/{table}",
+        "headers": {
+            "apikey": api_key,
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Prefer": "return=representation"
+        },
+    }
+
+@lru_cache(maxsize=None)
+def _session() -> requests.Session:
+    """HTTP session shared by all calls in the process (keeps connections alive)"""
+    return requests.Session()
+
+def _ensure_config():
+    """Ensure required configuration is present"""
+    cfg = _config()
+    if not cfg["url"] or not cfg["api_key"]:
+        raise RuntimeError("Configure SUPABASE_URL e SUPABASE_API_KEY no .env")
+    return cfg
+
+def create_invoice(filename: str):
+    """Create a new invoice record using Supabase REST API"""
+    cfg = _ensure_config()
+    payload = {
+        "filename": filename,
+        "status": "uploaded"
+    }
+    try:
+        response = _session().post(cfg["rest_url"], headers=cfg["headers"], data=json.dumps(payload), timeout=30)
+        if not response.ok:
+            raise RuntimeError(f"Erro ao criar invoice: {response.status_code} {response.text}")
+        result = response.json()
+        if result and len(result) > 0:
+            return result[0]
+        else:
+            raise RuntimeError("No data returned from insert operation")
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"Erro de conexão ao criar invoice: {str(e)}")
+    except Exception as e:
+        raise RuntimeError(f"Erro ao criar invoice: {str(e)}")
+
+def update_invoice(invoice_id: str, **fields):
+    """Update an existing invoice record using Supabase REST API"""
+    cfg = _ensure_config()
+    fields["updated_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    url = f"{cfg['rest_url']}?id=eq.{invoice_id}"
+    try:
+        response = _session().patch(url, headers=cfg["headers"], data=json.dumps(fields), timeout=30)
+        if not response.ok:
+            raise RuntimeError(f"Erro ao atualizar invoice: {response.status_code} {response.text}")
+        result = response.json()
+        if result and len(result) > 0:
+            return result[0]
+        else:
+            return None
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"Erro de conexão ao atualizar invoice: {str(e)}")
+    except Exception as e:
+        raise RuntimeError(f"Erro ao atualizar invoice: {str(e)}")
+
+class _Base64JsonBody:
+    """
+    Request body for a JSON object whose last value is a buffer encoded as
+    base64 while it is sent, so the encoded string and its json.dumps copy
+    never exist in memory. The length is known upfront (Content-Length).
+    """
+    RAW_CHUNK = 3 * 64 * 1024  # multiple of 3: encoded chunks concatenate into valid base64
+
+    def __init__(self, fields: dict, key: str, buffer):
+        head = json.dumps({**fields, key: ""})[:-2].encode()
+        self._buffer = memoryview(buffer).cast("B")
+        self._length = len(head) + 4 * ((len(self._buffer) + 2) // 3) + 2
+        self._chunks = self._iter_chunks(head)
+        self._pending, self._offset = b"", 0
+
+    def _iter_chunks(self, head: bytes):
+        yield head
+        for start in range(0, len(self._buffer), self.RAW_CHUNK):
+            yield base64.b64encode(self._buffer[start:start + self.RAW_CHUNK])
+        yield b'"}'
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        # http.client reads in small blocks; hand out slices of the current encoded chunk
+        if self._offset >= len(self._pending):
+            self._pending, self._offset = next(self._chunks, b""), 0
+        end = len(self._pending) if size is None or size < 0 else self._offset + size
+        data = self._pending[self._offset:end]
+        self._offset += len(data)
+        return data
+
+def upload_invoice_file(invoice_id: str, buffer, mime_type: str, filename: str, sha256: str = None):
+    """
+    Store the uploaded file in image_data, base64-encoding it from the buffer
+    (bytes, memoryview or mmap) as the request is sent instead of building
+    the encoded JSON payload in memory.
+    """
+    cfg = _ensure_config()
+    fields = {
+        "image_mime_type": mime_type,
+        "image_filename": filename,
+        "image_sha256": sha256,
+        "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    headers = {**cfg["headers"], "Prefer": "return=minimal"}
+    url = f"{cfg['rest_url']}?id=eq.{invoice_id}"
+    try:
+        response = _session().patch(url, headers=headers, data=_Base64JsonBody(fields, "image_data", buffer), timeout=120)
+        if not response.ok:
+            raise RuntimeError(f"Erro ao enviar arquivo: {response.status_code} {response.text}")
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"Erro de conexão ao enviar arquivo: {str(e)}")
+
+def list_invoices(limit: int = 100, columns: str = "*"):
+    """List invoices ordered by creation date using Supabase REST API"""
+    cfg = _ensure_config()
+    url = f"{cfg['rest_url']}?select={columns}&order=created_at.desc&limit={limit}"
+    try:
+        response = _session().get(url, headers=cfg["headers"], timeout=30)
+        if not response.ok:
+            raise RuntimeError(f"Erro ao listar invoices: {response.status_code} {response.text}")
+        result = response.json()
+        return result if result else []
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"Erro de conexão ao listar invoices: {str(e)}")
+    except Exception as e:
+        raise RuntimeError(f"Erro ao listar invoices: {str(e)}")
+
+class RpcNotFound(RuntimeError):
+    """The called database function does not exist (its SQL from the README was not run)"""
+
+def _request(method: str, path: str, action: str, params: dict = None, payload=None, prefer: str = None):
+    """Call a PostgREST endpoint relative to /rest/v1 and return the decoded JSON body"""
+    cfg = _ensure_config()
+    headers = dict(cfg["headers"])
+    if prefer:
+        headers["Prefer"] = prefer
+    data = json.dumps(payload) if payload is not None else None
+    try:
+        response = _session().request(method, f"{cfg['rest_base']}/{path}", headers=headers,
+                                      params=params, data=data, timeout=30)
+        if response.status_code == 404 and path.startswith("rpc/"):
+            raise RpcNotFound(f"Erro ao {action}: função {path[4:]} não encontrada no banco")
+        if not response.ok:
+            raise RuntimeError(f"Erro ao {action}: {response.status_code} {response.text}")
+        return response.json() if response.content else None
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"Erro de conexão ao {action}: {str(e)}")
+
+def save_establishment(establishment: dict):
+    """Upsert one establishments row by CNPJ (also used to save it early while the LLM is still streaming)"""
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    _request("POST", "establishments", "salvar estabelecimento",
+             params={"on_conflict": "cnpj"},
+             payload={**establishment, "updated_at": now},
+             prefer="resolution=merge-duplicates,return=minimal")
+
+def save_parsed_invoice(invoice_id: str, parsed: dict):
+    """
+    Write the normalized extraction (see extraction.parse_invoice) into the
+    establishments, invoices_parsed and invoice_items tables. Re-running it for
+    the same invoice replaces the previous rows.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    if parsed.get("establishment"):
+        save_establishment(parsed["establishment"])
+    _request("POST", "invoices_parsed", "salvar nota normalizada",
+             params={"on_conflict": "invoice_id"},
+             payload={**parsed["invoice"], "invoice_id": invoice_id, "updated_at": now},
+             prefer="resolution=merge-duplicates,return=minimal")
+    _request("DELETE", "invoice_items", "remover itens anteriores",
+             params={"invoice_id": f"eq.{invoice_id}"}, prefer="return=minimal")
+    if parsed.get("items"):
+        _request("POST", "invoice_items", "salvar itens",
+                 payload=[{**item, "invoice_id": invoice_id} for item in parsed["items"]],
+                 prefer="return=minimal")
+
+def get_invoice(invoice_id: str, columns: str = "*"):
+    """Fetch a single invoice (e.g. the heavy image_data/ocr_text/llm_response columns left out of list views)"""
+    result = _request("GET", _config()["table"], "carregar invoice",
+                      params={"select": columns, "id": f"eq.{invoice_id}"})
+    return result[0] if result else None
+
+def _rpc(function: str, action: str, **params):
+    return _request("POST", f"rpc/{function}", action, payload=params) or []
+
+def spend_by_establishment(date_from: str = None, date_to: str = None, max_rows: int = 50):
+    """Total spend and invoice count per CNPJ, aggregated by the database"""
+    return _rpc("spend_by_establishment", "consultar gastos por estabelecimento",
+                date_from=date_from, date_to=date_to, max_rows=max_rows)
+
+def top_products(date_from: str = None, date_to: str = None, max_rows: int = 20):
+    """Products with the highest total spend, aggregated by the database"""
+    return _rpc("top_products", "consultar produtos mais comprados",
+                date_from=date_from, date_to=date_to, max_rows=max_rows)
+
+# Lease-based job claiming for worker.py (see README, "Workers distribuídos")
+
+def claim_invoices(worker_id: str, lease_seconds: int = 300, max_rows: int = 1,
+                   shard_index: int = 0, shard_count: int = 1):
+    """
+    Atomically claim up to max_rows invoices waiting for OCR or LLM (status
+    uploaded/ocr_done) that are unclaimed or whose lease expired.
+    """
+    return _rpc("claim_invoices", "reservar invoices",
+                worker_id=worker_id, lease_seconds=lease_seconds, max_rows=max_rows,
+                shard_index=shard_index, shard_count=shard_count)
+
+def claim_invoice(invoice_id: str, worker_id: str, lease_seconds: int = 300):
+    """
+    Claim one specific invoice, whatever its status (manual actions and inline
+    processing in the app). Returns the row, or None while another worker holds
+    a live lease on it. Does not count as a processing attempt.
+    """
+    rows = _rpc("claim_invoice", "reservar invoice",
+                invoice_id=invoice_id, worker_id=worker_id, lease_seconds=lease_seconds)
+    return rows[0] if rows else None
+
+def renew_leases(worker_id: str, lease_seconds: int = 300):
+    """Heartbeat: extend every lease held by worker_id; returns the ids still held"""
+    return [row["id"] if isinstance(row, dict) else row
+            for row in _rpc("renew_invoice_leases", "renovar reservas",
+                            worker_id=worker_id, lease_seconds=lease_seconds)]
+
+def update_claimed_invoice(invoice_id: str, worker_id: str, **fields):
+    """
+    Update an invoice only while worker_id still holds its lease. Returns the
+    updated row, or None when the lease was lost (expired and reclaimed).
+    """
+    fields["updated_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    result = _request("PATCH", _config()["table"], "atualizar invoice reservada",
+                      params={"id": f"eq.{invoice_id}", "claimed_by": f"eq.{worker_id}"},
+                      payload=fields, prefer="return=representation")
+    return result[0] if result else None
+
+def release_invoice(invoice_id: str, worker_id: str, **fields):
+    """Apply the final fields and give the lease back"""
+    return update_claimed_invoice(invoice_id, worker_id, claimed_by=None, lease_expires_at=None, **fields)
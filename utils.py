@@ -1,15 +1,167 @@
-import logging, os
-from logging.handlers import RotatingFileHandler
+import logging, os, json, time, queue, random, atexit, datetime, contextlib, contextvars
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
-def setup_logger():
-    os.makedirs("logs", exist_ok=True)
+# Fields copied from `extra=` / log_context() into the JSON record
+CONTEXT_FIELDS = ("invoice_id", "stage", "duration_ms", "file_name")
+
+_log_context = contextvars.ContextVar("log_context", default={})
+_listeners = []
+_script_runs = 0
+_file_handler = None
+_process_queue = None
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the correlation fields at the top level"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class _ContextFilter(logging.Filter):
+    """Attach the fields from log_context() to every record"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _log_context.get().items():
+            if getattr(record, key, None) is None:
+                setattr(record, key, value)
+        return True
+
+class _DebugSampler(logging.Filter):
+    """Keep only a fraction of DEBUG records; higher levels always pass"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+class _StructuredQueueHandler(QueueHandler):
+    """QueueHandler that keeps the structured fields instead of pre-formatting the record"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Tracebacks are not picklable; render them in the calling thread
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def _get_file_handler() -> logging.Handler:
+    global _file_handler
+    if _file_handler is None:
+        # Logging configuration (all optional), read on first use so .env is already loaded
+        log_file = os.getenv("LOG_FILE", "logs/app.log")
+        max_bytes = int(os.getenv("LOG_MAX_BYTES", "20000000"))
+        backup_count = int(os.getenv("LOG_BACKUP_COUNT", "10"))
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        fh = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        if os.getenv("LOG_FORMAT", "json").lower() == "text":
+            fh.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        else:
+            fh.setFormatter(JsonFormatter())
+        _file_handler = fh
+    return _file_handler
+
+def _start_listener(q, handler: logging.Handler):
+    listener = QueueListener(q, handler, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return listener
+
+def _stop_listeners():
+    while _listeners:
+        _listeners.pop().stop()
+
+def setup_logger(log_queue=None):
+    """
+    Configure the "app" logger with a non-blocking, queue-based pipeline.
+
+    Records are enqueued by the calling thread and written to LOG_FILE by a
+    background listener thread. Worker processes pass the queue returned by
+    get_log_queue() in the parent so that a single process owns the file.
+    """
     logger = logging.getLogger("app")
-    logger.setLevel(logging.INFO)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    if log_queue is not None:
+        # Worker process: drop handlers inherited through fork, log only to the parent's queue
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
 
     if not logger.handlers:
-        fh = RotatingFileHandler("logs/app.log", maxBytes=2_000_000, backupCount=3)
-        fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-        fh.setFormatter(fmt)
-        logger.addHandler(fh)
+        if log_queue is None:
+            log_queue = queue.SimpleQueue()
+            _start_listener(log_queue, _get_file_handler())
+            atexit.register(_stop_listeners)
+        qh = _StructuredQueueHandler(log_queue)
+        qh.addFilter(_DebugSampler(float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.1"))))
+        qh.addFilter(_ContextFilter())
+        logger.addHandler(qh)
 
     return logger
+
+def get_log_queue():
+    """Return a multiprocessing queue drained into this process' log file (for worker processes)"""
+    global _process_queue
+    if _process_queue is None:
+        import multiprocessing
+        _process_queue = multiprocessing.Queue(-1)
+        _start_listener(_process_queue, _get_file_handler())
+        atexit.register(_stop_listeners)
+    return _process_queue
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Add correlation fields (invoice_id, stage, ...) to every record logged inside the block"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+@contextlib.contextmanager
+def log_stage(logger: logging.Logger, stage: str, **fields):
+    """Log the outcome and duration_ms of a processing stage"""
+    start = time.perf_counter()
+    with log_context(stage=stage, **fields):
+        try:
+            yield
+        except Exception:
+            duration_ms = round((time.perf_counter() - start) * 1000, 1)
+            logger.exception(f"Etapa {stage} falhou", extra={"duration_ms": duration_ms})
+            raise
+        duration_ms = round((time.perf_counter() - start) * 1000, 1)
+        logger.info(f"Etapa {stage} concluída", extra={"duration_ms": duration_ms})
+
+def record_startup_profile(logger: logging.Logger, started: float) -> dict:
+    """Log how long a Streamlit script run took; the first run in the process is the cold start"""
+    global _script_runs
+    _script_runs += 1
+    profile = {
+        "run": _script_runs,
+        "kind": "cold" if _script_runs == 1 else "rerun",
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    logger.info(f"Execução do script ({profile['kind']}) em {profile['duration_ms']} ms",
+                extra={"stage": "startup", "duration_ms": profile["duration_ms"]})
+    return profile
@@ -0,0 +1,179 @@
+"""
+Background worker that processes uploaded invoices (OCR + LLM) outside Streamlit.
+
+Any number of workers, on one or several hosts, can run against the same
+Supabase table. Each invoice is claimed through the claim_invoices RPC, which
+sets claimed_by/lease_expires_at atomically, so two workers never process the
+same row. A heartbeat thread renews the leases while the worker is alive; if
+it dies, the lease expires and another worker picks the invoice up again from
+its last completed stage (uploaded -> ocr_done -> llm_sent).
+
+Usage:
+    python worker.py                    # one worker process
+    python worker.py --processes 4      # four worker processes on this host
+    python worker.py --shard 0/2        # only invoices of shard 0 of 2
+    python worker.py --once             # drain the queue and exit
+    python worker.py --batch-size 4     # claim 4 invoices and send their LLM requests together
+"""
+import os, time, base64, socket, argparse, threading, multiprocessing
+from dotenv import load_dotenv
+
+from utils import setup_logger, log_stage, get_log_queue
+from ocr import run_ocr_result
+from llm_agent import get_llm_client
+from storage import claim_invoices, renew_leases, update_claimed_invoice, release_invoice, save_parsed_invoice
+from extraction import build_extraction_prompt, parse_invoice
+
+class LeaseLost(RuntimeError):
+    """The invoice lease expired and was claimed by another worker"""
+
+class LeaseHeartbeat(threading.Thread):
+    """Renews every lease held by worker_id (a worker or an app session) at a third of the lease duration"""
+
+    def __init__(self, worker_id: str, lease_seconds: int, logger):
+        super().__init__(name="lease-heartbeat", daemon=True)
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.logger = logger
+        self._stopped = threading.Event()
+
+    def run(self):
+        interval = max(1.0, self.lease_seconds / 3)
+        while not self._stopped.wait(interval):
+            try:
+                renew_leases(self.worker_id, self.lease_seconds)
+            except Exception:
+                self.logger.exception("Falha ao renovar reservas", extra={"stage": "heartbeat"})
+
+    def stop(self):
+        self._stopped.set()
+
+def _ocr_stage(inv: dict, worker_id: str, logger) -> str:
+    """OCR text of a claimed invoice, running OCR only if it is still in the uploaded stage"""
+    text = inv.get("ocr_text")
+    if inv.get("status") != "uploaded" and text:
+        return text
+    if not inv.get("image_data"):
+        raise RuntimeError("Invoice sem image_data; faça o upload novamente")
+    filename = inv.get("filename") or inv.get("image_filename") or ""
+    with log_stage(logger, "ocr", invoice_id=inv["id"], file_name=filename):
+        ocr_result = run_ocr_result(base64.b64decode(inv["image_data"]), filename)
+        text = ocr_result.text
+        if update_claimed_invoice(inv["id"], worker_id, status="ocr_done", ocr_text=text,
+                                  ocr_confidence=ocr_result.summary(), error=None) is None:
+            raise LeaseLost(inv["id"])
+    return text
+
+def _llm_finish(inv: dict, worker_id: str, resp: dict, logger):
+    """Save the LLM answer and give the invoice back as llm_sent"""
+    with log_stage(logger, "llm_save", invoice_id=inv["id"], file_name=inv.get("filename")):
+        # Normalized rows are replaced on every run, so writing them before the
+        # final status keeps a crash here safe to retry
+        parsed = parse_invoice(resp)
+        if parsed is None:
+            logger.warning("Resposta LLM sem JSON de nota fiscal válido; tabelas normalizadas não atualizadas")
+        else:
+            save_parsed_invoice(inv["id"], parsed)
+        if release_invoice(inv["id"], worker_id, status="llm_sent", llm_response=resp, error=None) is None:
+            raise LeaseLost(inv["id"])
+
+def _fail(inv: dict, worker_id: str, error: Exception, logger):
+    if isinstance(error, LeaseLost):
+        logger.warning("Reserva perdida; invoice assumida por outro worker", extra={"invoice_id": inv["id"]})
+        return
+    try:
+        release_invoice(inv["id"], worker_id, status="error", error=str(error))
+    except Exception:
+        logger.exception("Falha ao registrar erro", extra={"invoice_id": inv["id"]})
+
+def process_invoices(invoices: list, worker_id: str, logger):
+    """
+    Run the missing stages of the claimed invoices, resuming each one from its
+    current status. The LLM requests of the batch are sent together
+    (LLMClient.send_batch), so a local server can process them in parallel.
+    """
+    pending = []
+    for inv in invoices:
+        try:
+            pending.append((inv, _ocr_stage(inv, worker_id, logger)))
+        except Exception as e:
+            _fail(inv, worker_id, e, logger)
+    if not pending:
+        return
+
+    with log_stage(logger, "llm", invoice_id=pending[0][0]["id"] if len(pending) == 1 else None):
+        responses = get_llm_client().send_batch([build_extraction_prompt(text) for _, text in pending])
+    for (inv, _), resp in zip(pending, responses):
+        try:
+            if isinstance(resp, Exception):
+                raise resp
+            _llm_finish(inv, worker_id, resp, logger)
+        except Exception as e:
+            _fail(inv, worker_id, e, logger)
+
+def run_worker(worker_id: str, lease_seconds: int = 300, batch_size: int = 1, poll_interval: float = 5.0,
+               shard_index: int = 0, shard_count: int = 1, once: bool = False, log_queue=None):
+    """Claim and process invoices until interrupted (or until the queue is empty with once=True)"""
+    load_dotenv()
+    logger = setup_logger(log_queue)
+    logger.info(f"Worker {worker_id} iniciado (shard {shard_index}/{shard_count})")
+    heartbeat = LeaseHeartbeat(worker_id, lease_seconds, logger)
+    heartbeat.start()
+    try:
+        while True:
+            try:
+                claimed = claim_invoices(worker_id, lease_seconds, batch_size, shard_index, shard_count)
+            except Exception:
+                logger.exception("Falha ao reservar invoices", extra={"stage": "claim"})
+                claimed = []
+            if not claimed:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+            process_invoices(claimed, worker_id, logger)
+    finally:
+        heartbeat.stop()
+        logger.info(f"Worker {worker_id} finalizado")
+
+def _parse_shard(value: str):
+    index, _, count = value.partition("/")
+    index, count = int(index), int(count or 1)
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("use --shard INDICE/TOTAL, com 0 <= INDICE < TOTAL")
+    return index, count
+
+def main(argv=None):
+    # Before building the parser: option defaults such as WORKER_LEASE_SECONDS may come from .env
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Worker de OCR + LLM com reserva por lease")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--lease-seconds", type=int, default=int(os.getenv("WORKER_LEASE_SECONDS", "300")))
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--poll-interval", type=float, default=5.0)
+    parser.add_argument("--shard", type=_parse_shard, default=(0, 1))
+    parser.add_argument("--once", action="store_true")
+    args = parser.parse_args(argv)
+
+    options = dict(lease_seconds=args.lease_seconds, batch_size=args.batch_size, poll_interval=args.poll_interval,
+                   shard_index=args.shard[0], shard_count=args.shard[1], once=args.once)
+    try:
+        if args.processes <= 1:
+            run_worker(args.worker_id, **options)
+            return
+        setup_logger()
+        log_queue = get_log_queue()
+        procs = [multiprocessing.Process(target=run_worker, args=(f"{args.worker_id}-{i}",),
+                                         kwargs={**options, "log_queue": log_queue})
+                 for i in range(args.processes)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        # Leases of invoices in progress expire and are picked up by other workers
+        pass
+
+if __name__ == "__main__":
+    main()